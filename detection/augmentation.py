@@ -1,14 +1,37 @@
+"""Аугментация обучающей выборки (images/*.jpg и labels/*.txt в формате YOLO).
+
+Исходные изображения распределяются по пулу процессов; каждый процесс
+один раз строит пайплайн albumentations и кодирует и пишет результаты в
+своём ограниченном пуле потоков. Случайность каждого варианта задаётся
+зерном от --seed, имени файла и номера варианта, поэтому повторный запуск
+даёт те же файлы {имя}_aug{k}.jpg. Окно с разметкой (--visualize N)
+показывается только для каждого N-го изображения.
+
+    python augmentation.py --per-image 5 --workers 8
+"""
+import argparse
+import multiprocessing as mp
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import albumentations as A
 import cv2
+import numpy as np
 import os
 import random
-import uuid
 from alive_progress import alive_bar
 from dotenv import load_dotenv 
 load_dotenv() 
 
 COLOR_RED = (255, 0, 0)
 COLOR_WHITE = (255, 255, 255)
+CATEGORY_ID_TO_NAME = {0: 'car', 1: 'people'}
+AUG_SUFFIX = "_aug"
+
+# Пайплайн и пул записи процесса-исполнителя, создаются один раз в _init_worker
+_pipeline = None
+_writer = None
 
 def get_image_files(data_folder_path):
     image_folder = os.path.join(data_folder_path, 'images')
@@ -55,48 +78,43 @@ def bbox_from_yolo_to_coco(image, bbox):
     
     return [x_min, y_min, w, h]
 
-def load_data_from_folders(data_folder):
-    images_folder = os.path.join(data_folder, 'images')
-    labels_folder = os.path.join(data_folder, 'labels')
-
-    image_files = [f for f in os.listdir(images_folder) if f.endswith('.jpg')]
-
-    category_id_to_name = {0: 'car', 1: 'people'} 
+def load_sample(data_folder, image_file):
+    """Изображение и его разметка YOLO: (image, bboxes, category_ids)."""
+    image = cv2.imread(os.path.join(data_folder, 'images', image_file))
+    label_path = os.path.join(data_folder, 'labels', image_file.replace('.jpg', '.txt'))
 
-    for image_file in image_files:
-        image_path = os.path.join(images_folder, image_file)
-        image = cv2.imread(image_path)
-        
-        label_file = image_file.replace('.jpg', '.txt')
-        label_path = os.path.join(labels_folder, label_file)
+    bboxes = []
+    category_ids = []
 
-        bboxes = []
-        category_ids = []
+    if os.path.exists(label_path):
+        with open(label_path, 'r') as file:
+            annotations = file.readlines()
+            for annotation in annotations:
+                parts = list(map(float, annotation.strip().split()))
+                if not parts:
+                    continue
+                category_id = int(parts[0]) 
 
-        if os.path.exists(label_path):
-            with open(label_path, 'r') as file:
-                annotations = file.readlines()
-                for annotation in annotations:
-                    parts = list(map(float, annotation.strip().split()))
-                    category_id = int(parts[0]) 
+                bboxes.append(parts[1:])
+                category_ids.append(category_id)
 
-                    bboxes.append(parts[1:])
-                    category_ids.append(category_id)
+    return image, bboxes, category_ids
 
-        yield image, bboxes, category_ids, category_id_to_name, image_file
-      
-def save_img(image, bboxes, category_ids):
-    images_folder = data_folder_path + 'images'
-    labels_folder = data_folder_path + 'labels'
-    
-    uuid_add_name = str(uuid.uuid4())
-    image_path = images_folder + "\\" + uuid_add_name + ".jpg"
-    label_path = labels_folder + "\\" + uuid_add_name + ".txt"
-    
-    combined = [[category_id, *bbox] for category_id, bbox in zip(category_ids, bboxes)]
-    cv2.imwrite(image_path, image)
-    
-    with open(label_path, 'w') as file:
+def load_data_from_folders(data_folder):
+    for image_file in get_image_files(data_folder):
+        image, bboxes, category_ids = load_sample(data_folder, image_file)
+        yield image, bboxes, category_ids, CATEGORY_ID_TO_NAME, image_file
+
+def save_img(output_folder, name, image, bboxes, category_ids, quality=95):
+    """Кодирует и пишет {name}.jpg в images и разметку {name}.txt в labels папки output_folder."""
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise IOError(f"JPEG encoding failed: {name}")
+    with open(os.path.join(output_folder, 'images', name + '.jpg'), 'wb') as file:
+        file.write(encoded.tobytes())
+
+    combined = [[int(category_id), *bbox] for category_id, bbox in zip(category_ids, bboxes)]
+    with open(os.path.join(output_folder, 'labels', name + '.txt'), 'w') as file:
         for item in combined:
             file.write(' '.join(map(str, item)) + '\n')
       
@@ -129,18 +147,89 @@ def get_pipeline(p):
         bbox_params=A.BboxParams(format='yolo', label_fields=['category_ids']),
     )
 
-data_folder_path = os.getenv("BASE_PATH_TRAIN_DATA") + "\\"
-data_generator = load_data_from_folders(data_folder_path)
-
-image_files = get_image_files(data_folder_path)
-total_iterations = len(image_files)
-
-diff_transform_per_image = int(os.getenv("AUGMENTATION_PER_IMAGE"))
-       
-with alive_bar(total_iterations) as bar:
-    for current_iteration, (image, bboxes, category_ids, category_id_to_name, image_file) in enumerate(data_generator):
-        for _ in range(diff_transform_per_image):
-            transformed = get_pipeline(p=0.2)(image=image, bboxes=bboxes, category_ids=category_ids)
-            visualize(transformed['image'], transformed['bboxes'], transformed['category_ids'], category_id_to_name)
-            save_img(transformed['image'], transformed['bboxes'], transformed['category_ids'])
-        bar()
\ No newline at end of file
+class BoundedWriter:
+    """Пул потоков для кодирования и записи; submit() ждёт, пока в работе больше max_pending задач."""
+
+    def __init__(self, workers=4, max_pending=16):
+        self.pool = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+def sample_seed(seed, image_file, index):
+    """Зерно варианта index изображения image_file; не зависит от того, какой процесс его обработает."""
+    return int(np.random.SeedSequence([seed, zlib.crc32(image_file.encode()), index]).generate_state(1)[0])
+
+def _init_worker(p, writers, max_pending):
+    global _pipeline, _writer
+    # Параллельность даёт пул процессов; потоки OpenCV внутри каждого только мешали бы
+    cv2.setNumThreads(1)
+    _pipeline = get_pipeline(p)
+    _writer = BoundedWriter(writers, max_pending)
+
+def augment_image(data_folder, output_folder, image_file, count, seed, quality=95, preview=False):
+    """count вариантов одного изображения (в процессе пула). Возвращает первый вариант, если нужен preview."""
+    image, bboxes, category_ids = load_sample(data_folder, image_file)
+    stem = os.path.splitext(image_file)[0]
+    futures = []
+    first = None
+    for k in range(count):
+        sample = sample_seed(seed, image_file, k)
+        random.seed(sample)
+        np.random.seed(sample)
+        if hasattr(_pipeline, 'set_random_seed'):
+            _pipeline.set_random_seed(sample)
+        transformed = _pipeline(image=image, bboxes=bboxes, category_ids=category_ids)
+        futures.append(_writer.submit(save_img, output_folder, f"{stem}{AUG_SUFFIX}{k}", transformed['image'],
+                                      transformed['bboxes'], transformed['category_ids'], quality))
+        if preview and first is None:
+            first = (transformed['image'], transformed['bboxes'], transformed['category_ids'])
+    # Задача завершается, когда все её файлы записаны: ошибки записи всплывают здесь
+    for future in futures:
+        future.result()
+    return first
+
+def augment_folder(data_folder, output_folder, per_image, workers=None, writers=4, max_pending=16, seed=0, p=0.2,
+                   quality=95, visualize_every=0):
+    """Аугментирует все исходные изображения папки; результаты предыдущих запусков (*_aug*) не берутся."""
+    image_files = [f for f in get_image_files(data_folder) if AUG_SUFFIX not in f]
+    for sub in ('images', 'labels'):
+        os.makedirs(os.path.join(output_folder, sub), exist_ok=True)
+
+    context = mp.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                             initargs=(p, writers, max_pending)) as pool, alive_bar(len(image_files)) as bar:
+        futures = [pool.submit(augment_image, data_folder, output_folder, image_file, per_image, seed, quality,
+                               visualize_every > 0 and i % visualize_every == 0)
+                   for i, image_file in enumerate(image_files)]
+        for future in as_completed(futures):
+            preview = future.result()
+            if preview is not None:
+                visualize(*preview, CATEGORY_ID_TO_NAME)
+            bar()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Augment a YOLO dataset (images/ and labels/) in parallel.")
+    parser.add_argument("--data", default=os.getenv("BASE_PATH_TRAIN_DATA"), help="Dataset folder (default: BASE_PATH_TRAIN_DATA)")
+    parser.add_argument("--out", help="Output folder (default: the dataset folder)")
+    parser.add_argument("--per-image", type=int, default=int(os.getenv("AUGMENTATION_PER_IMAGE", 1)),
+                        help="Variants per source image (default: AUGMENTATION_PER_IMAGE)")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: all cores)")
+    parser.add_argument("--writers", type=int, default=4, help="Encoding/writing threads per worker")
+    parser.add_argument("--max-pending", type=int, default=16, help="Queued writes per worker before transforms wait")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-p", type=float, default=0.2, help="Probability of each transform")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality")
+    parser.add_argument("--visualize", type=int, default=0, metavar="N", help="Show every N-th image's first variant")
+    args = parser.parse_args(argv)
+
+    augment_folder(args.data, args.out or args.data, args.per_image, args.workers, args.writers, args.max_pending,
+                   args.seed, args.p, args.quality, args.visualize)
+
+# Пул процессов заново импортирует модуль, поэтому запуск только под __main__
+if __name__ == "__main__":
+    main()
\ No newline at end of file
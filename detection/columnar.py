@@ -0,0 +1,84 @@
+import json
+import os
+
+import numpy as np
+
+COLUMNS = ("frame", "boxes", "conf", "cls")
+DTYPES = dict(frame=np.int32, boxes=np.float32, conf=np.float32, cls=np.int16)
+
+
+class ColumnWriter:
+    """Накопление детекций по кадрам и запись в каталог колонок .npy (см. ColumnStore)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.parts = {name: [] for name in COLUMNS}
+
+    def add(self, frame, boxes, conf, cls):
+        """Детекции одного кадра: боксы xyxy, уверенности и классы."""
+        boxes = np.asarray(boxes, DTYPES["boxes"]).reshape(-1, 4)
+        self.parts["frame"].append(np.full(len(boxes), frame, DTYPES["frame"]))
+        self.parts["boxes"].append(boxes)
+        self.parts["conf"].append(np.asarray(conf, DTYPES["conf"]).reshape(-1))
+        self.parts["cls"].append(np.asarray(cls, DTYPES["cls"]).reshape(-1))
+
+    def close(self, **metadata):
+        columns = {name: np.concatenate(parts) if parts else empty_column(name) for name, parts in self.parts.items()}
+        write_columns(self.directory, columns, **metadata)
+
+
+def empty_column(name):
+    return np.empty((0, 4) if name == "boxes" else 0, DTYPES[name])
+
+
+def write_columns(directory, columns, **metadata):
+    """Пишет колонки (строки отсортированы по кадру), индекс кадров и meta.json.
+
+    index.npy - смещения строк: строки кадра f лежат в [index[f], index[f + 1]).
+    """
+    os.makedirs(directory, exist_ok=True)
+    frame = columns["frame"]
+    frames = int(frame.max()) + 1 if len(frame) else 0
+    frames = max(frames, metadata.get("frame_count") or 0)
+    index = np.searchsorted(frame, np.arange(frames + 1)).astype(np.int64)
+    for name in COLUMNS:
+        np.save(os.path.join(directory, f"{name}.npy"), np.asarray(columns[name], DTYPES[name]))
+    np.save(os.path.join(directory, "index.npy"), index)
+    with open(os.path.join(directory, "meta.json"), "w") as file:
+        json.dump(dict(metadata, rows=len(frame), frames=frames), file, indent=2)
+
+
+class ColumnStore:
+    """Детекции видео в каталоге колонок: frame.npy, boxes.npy (xyxy), conf.npy, cls.npy.
+
+    Колонки открываются через mmap, поэтому чтение диапазона кадров не
+    загружает весь файл. Строки отсортированы по кадру, index.npy даёт
+    диапазон строк каждого кадра; метаданные (имена классов, fps, число
+    кадров) - в meta.json.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as file:
+            self.meta = json.load(file)
+        self.columns = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in COLUMNS}
+        self.index = np.load(os.path.join(directory, "index.npy"))
+
+    def __len__(self):
+        return len(self.columns["frame"])
+
+    @property
+    def frames(self):
+        return len(self.index) - 1
+
+    def rows(self, start, end=None):
+        """Колонки строк кадров [start, end) (по умолчанию одного кадра start)."""
+        end = start + 1 if end is None else end
+        start = min(max(start, 0), self.frames)
+        end = min(max(end, start), self.frames)
+        lo, hi = self.index[start], self.index[end]
+        return {name: column[lo:hi] for name, column in self.columns.items()}
+
+    def counts(self):
+        """Число детекций в каждом кадре."""
+        return np.diff(self.index)
@@ -0,0 +1,261 @@
+"""Кэш сырых детекций YOLO на диске.
+
+Ключ группы - отпечаток содержимого видео, хэш файла весов и параметры
+инференса (imgsz, iou, масштаб кадра); внутри группы детекции хранятся
+по номерам кадров. Модель запускается с низким порогом CACHE_CONF, а
+порог уверенности применяется при чтении, поэтому подбор порогов, типа
+трекера и интервалов повторной детекции идёт без повторного инференса.
+
+Кадры группы лежат кусками по chunk кадров в {группа}/chunk_{k}.npy:
+строки (кадр, x1, y1, x2, y2, conf, cls), отсортированные по кадру;
+кадр без детекций записан одной строкой с cls = -1. Куски читаются через
+mmap. Общий размер ограничен max_bytes: при превышении удаляются куски,
+к которым дольше всего не обращались (время обращения - mtime файла).
+"""
+import contextlib
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_CONF = 0.05
+EMPTY = -1
+
+
+def file_digest(path, block=2**20):
+    """SHA-256 содержимого файла (для весов модели)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for data in iter(lambda: file.read(block), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def video_fingerprint(path, samples=16, block=2**20):
+    """Отпечаток видео по размеру и samples блокам, равномерно взятым из файла.
+
+    Хэшировать многогигабайтный файл целиком на каждый запуск слишком
+    долго, а случайно совпасть размером и всеми блоками разные ролики не могут.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as file:
+        for offset in np.linspace(0, max(size - block, 0), samples).astype(np.int64):
+            file.seek(int(offset))
+            digest.update(file.read(block))
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def _locked(path, timeout=30.0):
+    """Файл блокировки path.lock; блокировка старше timeout считается брошенной упавшим процессом."""
+    lock = path + ".lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(lock)
+                deadline = time.monotonic() + timeout
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock)
+
+
+class DetectionCache:
+    """Детекции по группам (видео, веса, параметры) и номерам кадров.
+
+    put() копит новые кадры в памяти, flush() дописывает их в куски
+    атомарной заменой файла. Несколько процессов могут писать в один кэш:
+    дописывание куска идёт под файлом блокировки.
+    """
+
+    def __init__(self, directory, max_bytes=4 * 2**30, chunk=256, max_open=16, max_pending=4096):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk = chunk
+        self.max_open = max_open
+        self.max_pending = max_pending
+        self.pending = {}
+        self.pending_frames = 0
+        self.maps = OrderedDict()
+        self.size = sum(size for _, _, size in self._files())
+
+    def group(self, video, weights, **params):
+        """Имя группы для видео, весов и параметров инференса."""
+        key = dict(video=video_fingerprint(video), weights=file_digest(weights), conf=CACHE_CONF, **params)
+        name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:20]
+        directory = os.path.join(self.directory, name)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "key.json"), "w") as file:
+                json.dump(dict(key, path=os.path.abspath(video)), file, indent=2)
+        return name
+
+    def __contains__(self, item):
+        group, frame = item
+        k = frame // self.chunk
+        if frame in self.pending.get((group, k), {}):
+            return True
+        data = self._map(group, k)
+        return data is not None and np.searchsorted(data[:, 0], frame) < np.searchsorted(data[:, 0], frame + 1)
+
+    def get(self, group, frame):
+        """(xyxy, conf, cls) кадра или None, если кадр не в кэше."""
+        k = frame // self.chunk
+        rows = self.pending.get((group, k), {}).get(frame)
+        if rows is None:
+            data = self._map(group, k)
+            if data is None:
+                return None
+            lo, hi = np.searchsorted(data[:, 0], [frame, frame + 1])
+            if lo == hi:
+                return None
+            rows = np.array(data[lo:hi])
+        rows = rows[rows[:, 6] != EMPTY]
+        return rows[:, 1:5], rows[:, 5], rows[:, 6].astype(int)
+
+    def put(self, group, frame, xyxy, conf, cls):
+        xyxy = np.asarray(xyxy, np.float32).reshape(-1, 4)
+        rows = np.empty((max(len(xyxy), 1), 7), np.float32)
+        if len(xyxy):
+            rows[:, 0] = frame
+            rows[:, 1:5] = xyxy
+            rows[:, 5] = np.asarray(conf).reshape(-1)
+            rows[:, 6] = np.asarray(cls).reshape(-1)
+        else:
+            rows[0] = (frame, 0, 0, 0, 0, 0, EMPTY)
+        self.pending.setdefault((group, frame // self.chunk), {})[frame] = rows
+        self.pending_frames += 1
+        if self.pending_frames >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        for (group, k), frames in self.pending.items():
+            path = self._path(group, k)
+            # Открытую копию закрываем: на Windows файл под mmap не заменить
+            self.maps.pop(path, None)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            parts = [frames[frame] for frame in sorted(frames)]
+            with _locked(path):
+                if os.path.exists(path):
+                    existing = np.load(path)
+                    self.size -= os.path.getsize(path)
+                    parts.append(existing[~np.isin(existing[:, 0], list(frames))])
+                data = np.concatenate(parts)
+                data = data[np.argsort(data[:, 0], kind="stable")]
+                temp = f"{path}.{os.getpid()}.tmp.npy"
+                np.save(temp, data)
+                os.replace(temp, path)
+            self.size += os.path.getsize(path)
+        self.pending = {}
+        self.pending_frames = 0
+        if self.size > self.max_bytes:
+            self._evict()
+
+    def close(self):
+        self.flush()
+        self.maps.clear()
+
+    def _path(self, group, k):
+        return os.path.join(self.directory, group, f"chunk_{k:06d}.npy")
+
+    def _map(self, group, k):
+        path = self._path(group, k)
+        if path in self.maps:
+            self.maps.move_to_end(path)
+            return self.maps[path]
+        if not os.path.exists(path):
+            return None
+        data = np.load(path, mmap_mode="r")
+        # Время последнего обращения для вытеснения
+        os.utime(path)
+        self.maps[path] = data
+        while len(self.maps) > self.max_open:
+            self.maps.popitem(last=False)
+        return data
+
+    def _files(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                for chunk in os.scandir(entry.path):
+                    if chunk.name.startswith("chunk_") and not chunk.name.endswith(".tmp.npy"):
+                        stat = chunk.stat()
+                        yield chunk.path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        # Размер пересчитывается по диску: в кэш могли писать другие процессы
+        files = sorted(self._files(), key=lambda item: item[1])
+        self.size = sum(size for _, _, size in files)
+        target = self.max_bytes * 0.9
+        for path, _, size in files:
+            if self.size <= target:
+                break
+            self.maps.pop(path, None)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+class CachedModel:
+    """Модель YOLO, которая берёт детекции кадров видео из кэша и считает только недостающие.
+
+    params - параметры predict() (imgsz, iou), key - всё остальное, что
+    меняет детекции (например, масштаб кадров); и то и другое входит в
+    ключ группы. Без кэша (cache=None) модель просто запускается на всех кадрах.
+    """
+
+    def __init__(self, model, cache=None, video=None, weights=None, key=None, **params):
+        self.model = model
+        self.cache = cache
+        self.params = params
+        self.group = None if cache is None else cache.group(video, weights, **(key or {}), **params)
+
+    @property
+    def names(self):
+        return self.model.names
+
+    def cached(self, index, conf=0.25):
+        """Есть ли кадр в кэше: такой кадр можно не декодировать и передать в predict() как None."""
+        return self.cache is not None and conf >= CACHE_CONF and (self.group, index) in self.cache
+
+    def predict(self, frames, indices, conf=0.25):
+        """Список (xyxy, conf, cls) для кадров с номерами indices, с порогом уверенности conf."""
+        # Кэш хранит детекции от CACHE_CONF; более низкий порог кэшем не обслужить
+        use_cache = self.cache is not None and conf >= CACHE_CONF
+        results = [self.cache.get(self.group, index) if use_cache else None for index in indices]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            predict_conf = CACHE_CONF if use_cache else conf
+            predicted = self.model.predict([frames[i] for i in missing], conf=predict_conf, verbose=False, **self.params)
+            for i, result in zip(missing, predicted):
+                boxes = result.boxes.cpu().numpy()
+                results[i] = (boxes.xyxy, boxes.conf, boxes.cls.astype(int))
+                if use_cache:
+                    self.cache.put(self.group, indices[i], *results[i])
+        return [(xyxy[c >= conf], c[c >= conf], cls[c >= conf]) for xyxy, c, cls in results]
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+
+def open_cache(directory=None, max_mb=None):
+    """Кэш из аргументов или переменных окружения DETECTION_CACHE и DETECTION_CACHE_MB; None, если не задан."""
+    directory = directory or os.getenv("DETECTION_CACHE")
+    if not directory:
+        return None
+    max_mb = max_mb or float(os.getenv("DETECTION_CACHE_MB", 4096))
+    return DetectionCache(directory, max_bytes=int(max_mb * 2**20))
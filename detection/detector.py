@@ -1,19 +1,217 @@
-from ultralytics import YOLO 
+"""Детекция YOLO по видео.
+
+Без параметров - как раньше: model.predict() по всему видео с записью
+размеченного ролика. С --out видео делится на --shards диапазонов кадров,
+которые обрабатываются параллельно в --workers процессах (веса грузятся
+один раз на процесс); боксы, классы и уверенности пишутся в колоночное
+хранилище (columnar.ColumnStore). Размеченное видео по готовому
+хранилищу рисуется отдельным проходом --render без повторной детекции.
+С --cache (или DETECTION_CACHE) детекции кадров берутся из кэша
+(detection_cache.py), а модель запускается только на недостающих кадрах.
+
+    python detector.py --out detections --workers 4 --cache ~/.cache/detections
+    python detector.py --out detections --render annotated.mp4
+"""
+import argparse
+import multiprocessing as mp
 import os
-from dotenv import load_dotenv 
-load_dotenv() 
-  
-weights = os.getenv("WEIGHTS_PATH")
-model = YOLO(weights)
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ultralytics import YOLO
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from columnar import COLUMNS, ColumnStore, ColumnWriter, write_columns
+from detection_cache import CachedModel, open_cache
+load_dotenv()
 
-basePath = os.getenv("BASE_PATH_PHOTO")
-imagePaths = [basePath + imagePath for imagePath in os.listdir(basePath)]
+weights = os.getenv("WEIGHTS_PATH")
 videoPath = os.getenv("VIDEO_PATH")
 
-model.predict(
-    videoPath, 
-    save=True,
-    iou=0.4,
-    show_labels=True,
-    show_conf=False,
-    )
\ No newline at end of file
+# Модель и кэш процесса-исполнителя, создаются один раз в _init_worker
+_model = None
+_cache = None
+
+
+def predict_video(videoPath, weights):
+    """Детекция по всему видео в одном процессе с записью размеченного ролика (runs/detect)."""
+    model = YOLO(weights)
+    model.predict(
+        videoPath,
+        save=True,
+        iou=0.4,
+        show_labels=True,
+        show_conf=False,
+        )
+
+
+def _init_worker(weights, threads, cache_dir=None, cache_mb=None):
+    global _model, _cache
+    import torch
+    # Без ограничения каждый процесс занял бы все ядра под потоки torch
+    torch.set_num_threads(threads)
+    _model = YOLO(weights)
+    _cache = open_cache(cache_dir, cache_mb)
+
+
+def split_ranges(frame_count, shards):
+    """Равные диапазоны кадров [start, end); последний открыт до конца видео (end=None)."""
+    bounds = np.linspace(0, frame_count, shards + 1).astype(int)
+    ranges = [(int(bounds[i]), int(bounds[i + 1])) for i in range(shards) if bounds[i + 1] > bounds[i]]
+    if ranges:
+        ranges[-1] = (ranges[-1][0], None)
+    return ranges or [(0, None)]
+
+
+def detect_shard(videoPath, weights, start, end, overlap, directory, batch=8, iou=0.4, conf=0.25):
+    """Детекция кадров [start - overlap, end) в каталог колонок directory (в процессе пула)."""
+    first = max(start - overlap, 0)
+    model = CachedModel(_model, _cache, videoPath, weights, iou=iou)
+    videoCap = cv2.VideoCapture(videoPath)
+    videoCap.set(cv2.CAP_PROP_POS_FRAMES, first)
+    writer = ColumnWriter(directory)
+    index = first
+    indices, frames = [], []
+    while end is None or index < end:
+        # Кадры из кэша только захватываются, без декодирования
+        if model.cached(index, conf):
+            ret, frame = videoCap.grab(), None
+        else:
+            ret, frame = videoCap.read()
+        if ret:
+            indices.append(index)
+            frames.append(frame)
+            index += 1
+        if frames and (len(frames) == batch or not ret or index == end):
+            for i, (xyxy, confs, cls) in zip(indices, model.predict(frames, indices, conf)):
+                writer.add(i, xyxy, confs, cls)
+            indices, frames = [], []
+        if not ret:
+            break
+    videoCap.release()
+    writer.close(frame_count=index)
+    if _cache is not None:
+        _cache.flush()
+    return dict(start=start, first=first, end=index, names=model.names)
+
+
+def merge_shards(shards, directory, **metadata):
+    """Сводит каталоги осколков в одно хранилище; каждый кадр берётся из осколка, которому он принадлежит.
+
+    Кадры перекрытия обработаны двумя соседними осколками: число боксов
+    в них сравнивается, расхождение на большинстве кадров означает, что
+    перемотка видео встала не на тот кадр.
+    """
+    parts = {name: [] for name in COLUMNS}
+    seams = []
+    previous = None
+    for shard in shards:
+        store = ColumnStore(shard["directory"])
+        frame = store.columns["frame"]
+        owned = (frame >= shard["start"]) & (frame < shard["end"])
+        for name in COLUMNS:
+            parts[name].append(np.asarray(store.columns[name])[owned])
+        if previous is not None and shard["first"] < shard["start"]:
+            mine = store.counts()[shard["first"]:shard["start"]]
+            theirs = previous.counts()[shard["first"]:shard["start"]]
+            compared = min(len(mine), len(theirs))
+            mismatched = int((mine[:compared] != theirs[:compared]).sum())
+            seams.append(dict(frame=shard["start"], compared=compared, mismatched=mismatched))
+            if mismatched * 2 > compared:
+                print(f"Внимание: на стыке у кадра {shard['start']} не совпало {mismatched} из {compared} кадров")
+        previous = store
+    columns = {name: np.concatenate(part) for name, part in parts.items()}
+    write_columns(directory, columns, seams=seams, **metadata)
+
+
+def detect_sharded(videoPath, weights, directory, workers=None, shards=None, overlap=8, batch=8, iou=0.4, conf=0.25,
+                   cache_dir=None, cache_mb=None):
+    """Параллельная детекция видео по диапазонам кадров в колоночное хранилище directory."""
+    workers = workers or max(1, (os.cpu_count() or 1) // 2)
+    shards = shards or workers
+    videoCap = cv2.VideoCapture(videoPath)
+    frame_count = int(videoCap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = videoCap.get(cv2.CAP_PROP_FPS)
+    videoCap.release()
+
+    start_time = time.time()
+    os.makedirs(directory, exist_ok=True)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = mp.get_context("spawn")
+    initargs = (weights, threads, cache_dir, cache_mb)
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=initargs) as pool:
+        futures = []
+        for i, (start, end) in enumerate(split_ranges(frame_count, shards)):
+            shard_dir = os.path.join(directory, f"shard_{i:03d}")
+            futures.append((shard_dir, pool.submit(detect_shard, videoPath, weights, start, end, overlap, shard_dir,
+                                                   batch, iou, conf)))
+        results = [dict(future.result(), directory=shard_dir) for shard_dir, future in futures]
+
+    names = next((r["names"] for r in results if r["names"] is not None), {})
+    # Число кадров из контейнера бывает неточным, поэтому берётся фактически прочитанное
+    merge_shards(results, directory, video=os.path.abspath(videoPath), fps=fps, frame_count=results[-1]["end"],
+                 names={int(k): v for k, v in names.items()})
+    for result in results:
+        shutil.rmtree(result["directory"])
+    print(f"Кадров: {results[-1]['end']}, боксов: {len(ColumnStore(directory))}, за {time.time() - start_time:.1f} с")
+
+
+def render(videoPath, directory, output, show_conf=False):
+    """Размеченное видео по готовому хранилищу детекций, без повторного запуска модели."""
+    store = ColumnStore(directory)
+    names = store.meta.get("names", {})
+    videoCap = cv2.VideoCapture(videoPath)
+    fps = videoCap.get(cv2.CAP_PROP_FPS) or 30
+    size = (int(videoCap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(videoCap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+    index = 0
+    while True:
+        ret, frame = videoCap.read()
+        if not ret:
+            break
+        rows = store.rows(index)
+        for (x1, y1, x2, y2), conf, cls in zip(rows["boxes"].astype(int), rows["conf"], rows["cls"]):
+            label = names.get(str(cls), str(cls)) + (f" {conf:.2f}" if show_conf else "")
+            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            cv2.putText(frame, label, (x1, y1 - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+        writer.write(frame)
+        index += 1
+    writer.release()
+    videoCap.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="YOLO detection over a video.")
+    parser.add_argument("--video", default=videoPath, help="Input video (default: VIDEO_PATH)")
+    parser.add_argument("--weights", default=weights, help="Model weights (default: WEIGHTS_PATH)")
+    parser.add_argument("--out", help="Directory of the columnar detection store; enables sharded mode")
+    parser.add_argument("--workers", type=int, help="Worker processes")
+    parser.add_argument("--shards", type=int, help="Frame ranges to split the video into (default: workers)")
+    parser.add_argument("--overlap", type=int, default=8, help="Frames decoded before each range to check seams")
+    parser.add_argument("--batch", type=int, default=8, help="Frames per predict call")
+    parser.add_argument("--iou", type=float, default=0.4)
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--cache", help="Detection cache directory (default: DETECTION_CACHE)")
+    parser.add_argument("--cache-size", type=float, help="Detection cache size limit, MB (default: DETECTION_CACHE_MB or 4096)")
+    parser.add_argument("--render", metavar="OUTPUT", help="Draw boxes from the store into this video")
+    parser.add_argument("--detect", action=argparse.BooleanOptionalAction, default=True,
+                        help="Run detection (use --no-detect to only render an existing store)")
+    args = parser.parse_args(argv)
+
+    if args.out is None:
+        if args.render is not None:
+            parser.error("--render requires --out")
+        predict_video(args.video, args.weights)
+        return
+    if args.detect:
+        detect_sharded(args.video, args.weights, args.out, args.workers, args.shards, args.overlap, args.batch,
+                       args.iou, args.conf, args.cache, args.cache_size)
+    if args.render is not None:
+        render(args.video, args.out, args.render)
+
+
+# Пул процессов заново импортирует модуль, поэтому запуск только под __main__
+if __name__ == "__main__":
+    main()
\ No newline at end of file
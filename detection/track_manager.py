@@ -0,0 +1,264 @@
+import cv2
+import numpy as np
+
+TRACKER_TYPES = ("BOOSTING", "MIL", "KCF", "TLD", "MEDIANFLOW", "CSRT", "MOSSE")
+
+
+def create_tracker(tracker_type="MOSSE"):
+    """Трекер OpenCV по имени."""
+    if tracker_type == 'BOOSTING':
+        return cv2.legacy.TrackerBoosting_create()
+    elif tracker_type == 'MIL':
+        return cv2.TrackerMIL_create()
+    elif tracker_type == 'KCF':
+        return cv2.TrackerKCF_create()                   # хорошая точность и неплохая скорость работы
+    elif tracker_type == 'TLD':
+        return cv2.legacy.TrackerTLD_create()
+    elif tracker_type == 'MEDIANFLOW':
+        return cv2.legacy.TrackerMedianFlow_create()     # великолепная скорость работы (~60 fps)
+    elif tracker_type == 'CSRT':
+        return cv2.TrackerCSRT_create()
+    elif tracker_type == 'MOSSE':                        # Minimum Output Sum of Squared Error
+        return cv2.legacy.TrackerMOSSE_create()          # невероятная скорость работы и неплохая точность (~60fps)
+    raise ValueError(f"Unknown tracker type: {tracker_type}. Expected one of {TRACKER_TYPES}.")
+
+
+def xywh_to_xyxy(boxes):
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+    return np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+
+
+def xyxy_to_xywh(boxes):
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+    return np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+
+
+def iou_matrix(a, b):
+    """IoU всех пар боксов xyxy: матрица len(a) x len(b)."""
+    a = np.asarray(a, np.float32).reshape(-1, 4)
+    b = np.asarray(b, np.float32).reshape(-1, 4)
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0)
+
+
+def association_cost(tracks, detections, max_distance=1.0):
+    """Стоимость сопоставления боксов треков и детекций (xyxy): 1 - IoU плюс
+    расстояние между центрами в диагоналях бокса трека. Пары, которые не
+    пересекаются и отстоят дальше max_distance диагоналей, получают inf.
+    """
+    tracks = np.asarray(tracks, np.float32).reshape(-1, 4)
+    detections = np.asarray(detections, np.float32).reshape(-1, 4)
+    iou = iou_matrix(tracks, detections)
+    offset = (tracks[:, None, :2] + tracks[:, None, 2:] - detections[None, :, :2] - detections[None, :, 2:]) / 2
+    diagonal = np.maximum(np.hypot(*(tracks[:, 2:] - tracks[:, :2]).T), 1)
+    distance = np.hypot(offset[..., 0], offset[..., 1]) / diagonal[:, None]
+    cost = 1 - iou + distance
+    cost[(iou <= 0) & (distance > max_distance)] = np.inf
+    return cost
+
+
+def assign(cost):
+    """Оптимальное сопоставление строк и столбцов по матрице стоимости (inf - запрещённые пары).
+
+    Венгерский алгоритм из scipy; без scipy - жадно по возрастанию стоимости.
+    """
+    if cost.size == 0:
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+    finite = np.isfinite(cost)
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        rows, cols = [], []
+        order = np.argsort(cost, axis=None)
+        used_rows, used_cols = set(), set()
+        for r, c in zip(*np.unravel_index(order[:finite.sum()], cost.shape)):
+            if r not in used_rows and c not in used_cols:
+                used_rows.add(r)
+                used_cols.add(c)
+                rows.append(r)
+                cols.append(c)
+        return np.array(rows, np.intp), np.array(cols, np.intp)
+    # Запрещённые пары заменяются стоимостью больше любого допустимого решения и отбрасываются после
+    big = (cost[finite].max() + 1) * (min(cost.shape) + 1) if finite.any() else 1
+    rows, cols = linear_sum_assignment(np.where(finite, cost, big))
+    keep = finite[rows, cols]
+    return rows[keep], cols[keep]
+
+
+class Track:
+    """Цель: номер, трекер OpenCV, последний bbox (x, y, w, h), класс и состояние.
+
+    state - "tracked", пока трекер OpenCV её держит, и "lost" после его
+    сбоя (bbox - последнее известное положение). misses - число проходов
+    детектора подряд, в которых цель не нашлась.
+    """
+
+    def __init__(self, track_id, tracker, bbox, cls=None):
+        self.id = track_id
+        self.tracker = tracker
+        self.bbox = tuple(bbox)
+        self.cls = cls
+        self.state = "tracked"
+        self.misses = 0
+
+
+class TrackManager:
+    """Несколько целей одновременно, каждая со своим трекером OpenCV.
+
+    update() продвигает все трекеры на кадр. correct() за один проход
+    детектора сопоставляет все детекции со всеми целями (стоимость по IoU
+    и расстоянию между центрами, оптимальное назначение) и
+    переинициализирует трекеры найденных целей на боксах детекций. Цель,
+    не найденная max_misses проходов подряд, удаляется.
+    """
+
+    def __init__(self, tracker_type="MOSSE", max_misses=5, max_distance=1.0):
+        self.tracker_type = tracker_type
+        self.max_misses = max_misses
+        self.max_distance = max_distance
+        self.tracks = {}
+        self.next_id = 1
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, frame, bbox, cls=None):
+        """Новая цель с bbox (x, y, w, h). Возвращает её номер или None, если трекер не инициализировался."""
+        bbox = tuple(int(v) for v in bbox)
+        tracker = create_tracker(self.tracker_type)
+        if tracker.init(frame, bbox) is False:
+            return None
+        track = Track(self.next_id, tracker, bbox, cls)
+        self.tracks[track.id] = track
+        self.next_id += 1
+        return track.id
+
+    def remove(self, track_id):
+        self.tracks.pop(track_id, None)
+
+    def update(self, frame, ids=None):
+        """Продвигает трекеры (все или только ids) на кадр. Возвращает {номер: bbox} удерживаемых целей."""
+        for track in self.tracks.values():
+            if track.state != "tracked" or (ids is not None and track.id not in ids):
+                continue
+            ok, bbox = track.tracker.update(frame)
+            if ok:
+                track.bbox = tuple(bbox)
+            else:
+                track.state = "lost"
+        return self.boxes()
+
+    def boxes(self):
+        return {track.id: track.bbox for track in self.tracks.values() if track.state == "tracked"}
+
+    def lost(self):
+        return [track.id for track in self.tracks.values() if track.state == "lost"]
+
+    def correct(self, frame, detections, classes=None):
+        """Сопоставляет детекции (xyxy в координатах frame) с целями и переинициализирует найденные.
+
+        classes - классы детекций: цель с известным классом сопоставляется
+        только с детекциями своего класса. Возвращает номера
+        переинициализированных целей.
+        """
+        tracks = list(self.tracks.values())
+        detections = np.asarray(detections, np.float32).reshape(-1, 4)
+        if not tracks:
+            return []
+
+        cost = association_cost(xywh_to_xyxy([track.bbox for track in tracks]), detections, self.max_distance)
+        if classes is not None:
+            classes = np.asarray(classes).reshape(-1)
+            known = np.array([track.cls is not None for track in tracks])
+            track_cls = np.array([-1 if track.cls is None else track.cls for track in tracks])
+            cost[known[:, None] & (track_cls[:, None] != classes[None, :])] = np.inf
+        rows, cols = assign(cost)
+
+        corrected = []
+        matched = set(rows.tolist())
+        boxes = xyxy_to_xywh(detections[cols]).astype(int)
+        for row, bbox in zip(rows, boxes):
+            track = tracks[row]
+            track.tracker = create_tracker(self.tracker_type)
+            if track.tracker.init(frame, tuple(bbox)) is False:
+                track.state = "lost"
+                continue
+            track.bbox = tuple(bbox)
+            track.state = "tracked"
+            track.misses = 0
+            corrected.append(track.id)
+        for i, track in enumerate(tracks):
+            if i not in matched:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    self.remove(track.id)
+        return corrected
+
+    def find(self, bbox, min_iou=0.3):
+        """Номер удерживаемой цели, бокс которой пересекается с bbox (x, y, w, h) с IoU не меньше min_iou, или None."""
+        boxes = self.boxes()
+        if not boxes:
+            return None
+        ids = list(boxes)
+        iou = iou_matrix(xywh_to_xyxy([boxes[i] for i in ids]), xywh_to_xyxy(bbox))[:, 0]
+        best = int(np.argmax(iou))
+        return ids[best] if iou[best] >= min_iou else None
+
+    def closest(self, point):
+        """Номер цели, центр bbox которой ближе всего к точке, или None."""
+        if not self.tracks:
+            return None
+        ids = list(self.tracks)
+        boxes = np.array([self.tracks[i].bbox for i in ids], np.float32)
+        centers = boxes[:, :2] + boxes[:, 2:] / 2
+        return ids[int(np.argmin(np.hypot(*(centers - point).T)))]
+
+
+class BoxTracker:
+    """Сопоставление детекций от кадра к кадру без трекеров OpenCV (офлайн-обработка).
+
+    Цели хранятся массивами: последний бокс xyxy, класс и число проходов
+    без совпадения. update() назначает детекциям кадра номера целей по той
+    же стоимости, что и TrackManager.correct(); несопоставленные детекции
+    получают новые номера, цели без совпадения дольше max_age проходов
+    забываются.
+    """
+
+    def __init__(self, max_age=3, max_distance=1.0):
+        self.max_age = max_age
+        self.max_distance = max_distance
+        self.boxes = np.empty((0, 4), np.float32)
+        self.ids = np.empty(0, np.int64)
+        self.cls = np.empty(0, np.int64)
+        self.age = np.empty(0, np.int64)
+        self.next_id = 1
+
+    def update(self, detections, classes=None):
+        """Номера целей для детекций кадра (xyxy) в порядке детекций."""
+        detections = np.asarray(detections, np.float32).reshape(-1, 4)
+        classes = np.full(len(detections), -1) if classes is None else np.asarray(classes, np.int64).reshape(-1)
+        cost = association_cost(self.boxes, detections, self.max_distance)
+        cost[self.cls[:, None] != classes[None, :]] = np.inf
+        rows, cols = assign(cost)
+
+        ids = np.zeros(len(detections), np.int64)
+        ids[cols] = self.ids[rows]
+        new = np.ones(len(detections), bool)
+        new[cols] = False
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+
+        self.age += 1
+        self.age[rows] = 0
+        self.boxes[rows] = detections[cols]
+        keep = self.age <= self.max_age
+        self.boxes = np.concatenate([self.boxes[keep], detections[new]])
+        self.ids = np.concatenate([self.ids[keep], ids[new]])
+        self.cls = np.concatenate([self.cls[keep], classes[new]])
+        self.age = np.concatenate([self.age[keep], np.zeros(new.sum(), np.int64)])
+        return ids
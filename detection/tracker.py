@@ -1,9 +1,14 @@
 from ultralytics import YOLO 
 import cv2
 import os
+import queue
+import threading
+from collections import deque
 from time import time
 import numpy as np
 from dotenv import load_dotenv
+from detection_cache import CachedModel, open_cache
+from track_manager import TrackManager
 load_dotenv() 
 
 weights = os.getenv("WEIGHTS_PATH")
@@ -14,10 +19,8 @@ videoCap = cv2.VideoCapture(videoPath)
 ok, frame = videoCap.read()
 model(frame)
 
-def dist_to_xy(center_xy, x2, y2):
-    x1 = center_xy[0]
-    y1 = center_xy[1]
-    return np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+# Детекции всего кадра кэшируются на диске, если задан DETECTION_CACHE (см. detection_cache.py)
+cached_model = CachedModel(model, open_cache(), videoPath, weights)
 
 def resize_image(frame):
     height, width = frame.shape[:2]  # Получаем высоту и ширину изображения
@@ -35,91 +38,181 @@ def resize_image(frame):
     resized_frame = cv2.resize(frame, (new_width, new_height))  # Изменяем размер изображения
     return resized_frame
 
-def detect_objects(frame):
-    results = model(frame)
-    return results[0].boxes.cpu().numpy()
+# Повторный поиск цели ведётся в окрестности последнего bbox: сторона окна -
+# ROI_EXPAND размеров bbox, но не меньше ROI_MIN_SIZE пикселей
+ROI_EXPAND = 3.0
+ROI_MIN_SIZE = 256
+
+def detect_objects(frame, index):
+    """Боксы xyxy на всём кадре с номером index в видео."""
+    xyxy, _, _ = cached_model.predict([frame], [index])[0]
+    return xyxy
+
+def roi_around(bbox, frame_shape, expand=ROI_EXPAND, min_size=ROI_MIN_SIZE):
+    """Окно (x0, y0, x1, y1) вокруг bbox (x, y, w, h), обрезанное по границам кадра."""
+    x, y, w, h = bbox
+    cx, cy = x + w / 2, y + h / 2
+    side = max(max(w, h) * expand, min_size)
+    height, width = frame_shape[:2]
+    x0, y0 = max(int(cx - side / 2), 0), max(int(cy - side / 2), 0)
+    x1, y1 = min(int(cx + side / 2), width), min(int(cy + side / 2), height)
+    return x0, y0, x1, y1
+
+def detect_in_roi(frame, bbox, index):
+    """Детекция только в окне вокруг bbox. Возвращает боксы xyxy в координатах кадра."""
+    x0, y0, x1, y1 = roi_around(bbox, frame.shape)
+    if x1 <= x0 or y1 <= y0:
+        return np.empty((0, 4), np.float32)
+    if cached_model.cached(index):
+        # Детекции всего кадра уже в кэше: окно берётся из них без запуска модели.
+        # Сами запуски по окну не кэшируются - окно зависит от состояния трекера
+        boxes = detect_objects(frame, index)
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        return boxes[(centers >= (x0, y0)).all(axis=1) & (centers < (x1, y1)).all(axis=1)]
+    # Окно подаётся в своём разрешении (кратно 32): иначе модель растянет его до 640 и выигрыша не будет
+    imgsz = min(640, -(-max(x1 - x0, y1 - y0) // 32) * 32)
+    results = model(frame[y0:y1, x0:x1], imgsz=imgsz)
+    return results[0].boxes.cpu().numpy().xyxy + (x0, y0, x0, y0)
 
 def find_closest_bbox(boxes, target_point):
-    min_dist = float('inf')
-    best_bb = None
-
-    for box in boxes:
-        r_xyxy = box.xyxy[0].astype(int)
-        x1, y1, x2, y2 = r_xyxy
-        current_center = ((x2 + x1) // 2, (y2 + y1) // 2)
-        
-        distance = dist_to_xy(target_point, current_center[0], current_center[1])
-        if distance < min_dist:
-            min_dist = distance
-            best_bb = [x1, y1, x2 - x1, y2 - y1]  # Формат (x, y, w, h)
-
-    return best_bb
-
-def get_bbox(frame, click_x, click_y):
-    start_time = time()
-    boxes = detect_objects(frame)
-
-    closest_bbox = find_closest_bbox(boxes, (click_x, click_y))
-
-    print("Time to find car:", time() - start_time)
-    print("Best bbox:", closest_bbox)
-
-    if closest_bbox:
-        x, y, w, h = closest_bbox
-        frame_cropped = frame[y:y + h, x:x + w]
-        resized_frame = resize_image(frame_cropped)
-        cv2.imshow("Detected Object", resized_frame)
-        return closest_bbox
-    return None
-
-def init_tracker(frame, bbox):
-    # Инициализируем трекер с полученным bbox
-    global tracker, tracker_init, tracker_type
-    
-    tracker_init = True
-    
-    if tracker_type == 'BOOSTING':
-        tracker = cv2.legacy.TrackerBoosting_create()
-    elif tracker_type == 'MIL':
-        tracker = cv2.TrackerMIL_create()
-    elif tracker_type == 'KCF':
-        tracker = cv2.TrackerKCF_create()                   # хорошая точность и неплохая скорость работы
-    elif tracker_type == 'TLD':
-        tracker = cv2.legacy.TrackerTLD_create()
-    elif tracker_type == 'MEDIANFLOW':
-        tracker = cv2.legacy.TrackerMedianFlow_create()     # великолепная скорость работы (~60 fps)
-    elif tracker_type == 'CSRT':
-        tracker = cv2.TrackerCSRT_create()  
-    elif tracker_type == 'MOSSE':                           # Minimum Output Sum of Squared Error
-        tracker = cv2.legacy.TrackerMOSSE_create()          # невероятная скорость работы и неплохая точность (~60fps)
-    
-    return tracker.init(frame, bbox)
+    """Ближайший к target_point бокс из массива xyxy в формате (x, y, w, h)."""
+    boxes = np.asarray(boxes).reshape(-1, 4).astype(int)
+    if len(boxes) == 0:
+        return None
+    centers = (boxes[:, :2] + boxes[:, 2:]) // 2
+    x1, y1, x2, y2 = boxes[np.argmin(np.hypot(*(centers - target_point).T))]
+    return [x1, y1, x2 - x1, y2 - y1]  # Формат (x, y, w, h)
+
+def show_detected_object(frame, bbox):
+    x, y, w, h = bbox
+    frame_cropped = frame[y:y + h, x:x + w]
+    resized_frame = resize_image(frame_cropped)
+    cv2.imshow("Detected Object", resized_frame)
 
 def mouseClick(event, x, y, flags, param):
-    global bbox, frame
+    global selected_id
     
-    if event == cv2.EVENT_LBUTTONDOWN:
-        bbox = get_bbox(frame, x, y)
-        if bbox is not None:
-            if not init_tracker(frame, bbox): 
-                print("Error initialize tracker!")
-        else:
-            print("BBox not found")
+    if event == cv2.EVENT_LBUTTONDOWN and frame_buffer:
+        # Новая цель добавляется к уже отслеживаемым
+        frame_id, clean_frame = frame_buffer[-1]
+        detection_worker.submit(frame_id, clean_frame, "click", (x, y))
+    elif event == cv2.EVENT_RBUTTONDOWN:
+        # Правый клик снимает ближайшую цель
+        manager.remove(manager.closest((x, y)))
+        if selected_id not in manager.tracks:
+            selected_id = None
 
-def yolo_autodetect(frame, last_known_bbox=None):
-    global tracker
-    boxes = detect_objects(frame)
+def detect_targets(frame, targets, index):
+    """Детекции xyxy для сопоставления с целями (x, y, w, h) за один проход модели.
 
-    if last_known_bbox:
-        x, y, w, h = last_known_bbox
-        last_center = (x + w // 2, y + h // 2)
-        closest_bbox = find_closest_bbox(boxes, last_center)
+    Для единственной цели модель запускается на окне вокруг неё, а на всём
+    кадре - только если в окне нет кандидатов; для нескольких целей - один
+    раз на всём кадре.
+    """
+    if len(targets) == 1:
+        boxes = detect_in_roi(frame, targets[0], index)
+        if len(boxes):
+            return boxes
+    return detect_objects(frame, index)
 
-        if closest_bbox:
-            init_tracker(frame, closest_bbox)
-            return closest_bbox
-    
-    return None
+class DetectionWorker:
+    """Фоновый поток детекции: модель работает в своём темпе и не блокирует цикл трекинга.
+
+    Запрос - кадр с номером, вид ("click" - новая цель по точке, "detect" -
+    детекции для коррекции текущих целей) и его аргумент. Слот запроса
+    один: новый запрос заменяет ещё не взятый в работу (побеждает последний
+    кадр), но коррекция не вытесняет ожидающий клик. Результаты (номер
+    кадра, вид, bbox или None для клика, боксы xyxy для коррекции)
+    забираются через poll().
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.request = None
+        self.results = queue.SimpleQueue()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, frame_id, frame, kind, target):
+        with self.condition:
+            if self.request is not None and self.request[2] == "click" and kind != "click":
+                return
+            self.request = (frame_id, frame, kind, target)
+            self.condition.notify()
+
+    def poll(self):
+        try:
+            return self.results.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.request is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                request, self.request = self.request, None
+            frame_id, frame, kind, target = request
+            start_time = time()
+            if kind == "click":
+                result = find_closest_bbox(detect_objects(frame, frame_id), target)
+                print("Time to find car:", time() - start_time)
+            else:
+                result = detect_targets(frame, target, frame_id)
+            self.results.put((frame_id, kind, result))
+
+def request_detection():
+    """Отправляет в фоновый поток детекцию для коррекции всех целей на последнем кадре."""
+    if len(manager) and frame_buffer:
+        frame_id, clean_frame = frame_buffer[-1]
+        targets = [track.bbox for track in manager.tracks.values()]
+        detection_worker.submit(frame_id, clean_frame, "detect", targets)
+
+def apply_detection(result):
+    """Применяет результат фоновой детекции к целям.
+
+    Детекция относится к уже прошедшему кадру, поэтому трекеры новых и
+    скорректированных целей инициализируются на этом кадре из буфера и
+    догоняют текущий, обновляясь по всем кадрам, накопленным с тех пор.
+    """
+    global selected_id
+    frame_id, kind, found = result
+    if not frame_buffer or frame_buffer[0][0] > frame_id:
+        # Кадр детекции уже вытеснен из буфера - догнать нечем, ждём следующего результата
+        return
+
+    frames = [f for i, f in frame_buffer if i >= frame_id]
+    if kind == "click":
+        print("Best bbox:", found)
+        if found is None:
+            print("BBox not found")
+            return
+        # Боксы целей уже догнали текущий кадр, а found - с кадра детекции; небольшой сдвиг покрывает низкий порог IoU
+        existing = manager.find(found)
+        if existing is not None:
+            print("Object already tracked:", existing)
+            selected_id = existing
+            return
+        show_detected_object(frames[0], found)
+        track_id = manager.add(frames[0], found)
+        if track_id is None:
+            print("Error initialize tracker!")
+            return
+        selected_id = track_id
+        ids = [track_id]
+    else:
+        ids = manager.correct(frames[0], found)
+    for buffered in frames[1:]:
+        manager.update(buffered, ids)
     
 def draw_bbox(frame, bbox, color=(255, 0, 0), thickness=2):
     """Рисует bounding box на кадре."""
@@ -132,19 +225,17 @@ def show_tracked_object(frame, bbox, window_name="Tracked Object"):
     tracked_frame = frame[y:y + h, x:x + w]
     cv2.imshow(window_name, tracked_frame)
 
-def process_tracking(frame, bbox):
-    """Обрабатывает трекинг и корректирует его при необходимости."""
-    global tracker_init, last_frame_bbox, tracker
-
-    if tracker_init:
-        ok, bbox = tracker.update(frame)
-        if ok:
-            draw_bbox(frame, bbox)
-            show_tracked_object(frame, bbox)
-            last_frame_bbox = bbox
-        else:
-            tracker_init = False
-            last_frame_bbox = yolo_autodetect(frame, last_frame_bbox)
+def process_tracking(frame):
+    """Обрабатывает трекинг всех целей и запрашивает коррекцию, если какие-то потеряны."""
+    boxes = manager.update(frame)
+    for track_id, bbox in boxes.items():
+        draw_bbox(frame, bbox)
+        x, y = int(bbox[0]), int(bbox[1])
+        cv2.putText(frame, str(track_id), (x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 0, 0), 2)
+    if selected_id in boxes:
+        show_tracked_object(frame, boxes[selected_id])
+    if manager.lost():
+        request_detection()
 
 def should_update_tracker(last_detection_time, interval=1.0):
     """Определяет, нужно ли обновить трекер на основе времени."""
@@ -153,25 +244,40 @@ def should_update_tracker(last_detection_time, interval=1.0):
 cv2.namedWindow("Main")
 cv2.setMouseCallback("Main", mouseClick)
 
-bbox = (0, 0, 0, 0)
-tracker_init = False
-    
 # Задаём тип трекера
 tracker_type = 'MOSSE'
-tracker = None
+manager = TrackManager(tracker_type)
+# Цель, показываемая в отдельном окне (последняя выбранная кликом)
+selected_id = None
 
 last_detection_time = time()
-last_frame_bbox = None
+
+# Детекция идёт в фоне; последние кадры (до рисования на них) хранятся, чтобы
+# трекер догонял текущий кадр после результата для более раннего кадра
+BUFFER_FRAMES = 60
+frame_buffer = deque(maxlen=BUFFER_FRAMES)
+# Номер кадра в видео (кадр 0 прочитан при прогреве модели) - он же ключ кэша детекций
+frame_id = 0
+detection_worker = DetectionWorker()
 
 while True:
     ret, frame = videoCap.read()
     if not ret:
         break
 
-    process_tracking(frame, last_frame_bbox)
+    # Результаты применяются до добавления нового кадра: трекер догоняет
+    # предыдущий кадр, а текущий обработает process_tracking
+    result = detection_worker.poll()
+    while result is not None:
+        apply_detection(result)
+        result = detection_worker.poll()
+    frame_id += 1
+    frame_buffer.append((frame_id, frame.copy()))
+
+    process_tracking(frame)
 
     if should_update_tracker(last_detection_time):
-        last_frame_bbox = yolo_autodetect(frame, last_frame_bbox)
+        request_detection()
         last_detection_time = time()
 
     cv2.imshow('Main', frame)
@@ -179,5 +285,7 @@ while True:
     if cv2.waitKey(1) & 0xFF == ord('q'):
         break
 
+detection_worker.close()
+cached_model.close()
 videoCap.release()
 cv2.destroyAllWindows()
\ No newline at end of file
@@ -1,41 +1,206 @@
+"""Трекинг YOLO по видео.
+
+Без параметров - просмотр в окне, как раньше. С --offline видео
+обрабатывается без окна: кадры декодируются батчами, детектор
+запускается на всём батче, а детекции по порядку кадров связываются в
+треки (track_manager.BoxTracker). При --stride k детектор работает на
+каждом k-м кадре, боксы на промежуточных кадрах интерполируются между
+соседними проходами или повторяются с предыдущего (--fill propagate).
+Треки пишутся в .npz с колонками frame, boxes (xyxy в пикселях исходного
+кадра), conf, cls, track, interpolated и именами классов names. С
+--cache (или DETECTION_CACHE) детекции берутся из кэша detection_cache.py,
+и повторные прогоны с другими порогами и шагом не запускают модель.
+
+    python tracker_yolo.py --offline tracks.npz --video flight.mp4 --batch 16 --stride 3
+"""
+import argparse
+import time
+
 from ultralytics import YOLO 
 import cv2
 import os
+import numpy as np
 from dotenv import load_dotenv
+from detection_cache import CachedModel, open_cache
+from track_manager import BoxTracker
 load_dotenv() 
 
 weights = os.getenv("WEIGHTS_PATH")
 model = YOLO(weights)
 
 videoPath = os.getenv("VIDEO_PATH")
-videoCap = cv2.VideoCapture(videoPath)
-
-while True:
-    ret, frame = videoCap.read()
-    if not ret:
-        break
-    
-    frame = cv2.resize(frame, (frame.shape[1] // 2, frame.shape[0] // 2))
-    results = model.track(frame, stream=True, persist=True)
-
-    for result in results:
-        classes_names = result.names
-
-        for box in result.boxes:
-            if box.conf[0] > 0.4:
-                [x1, y1, x2, y2] = box.xyxy[0]
-                x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-
-                cls = int(box.cls[0])
-                class_name = classes_names[cls]
-                
-                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                cv2.putText(frame, f'{classes_names[int(box.cls[0])]} {box.conf[0]:.2f}', (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                
-    cv2.imshow('frame', frame)
-
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-videoCap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+
+FILL_MODES = ("interpolate", "propagate")
+
+
+def track_live(videoPath):
+    videoCap = cv2.VideoCapture(videoPath)
+
+    while True:
+        ret, frame = videoCap.read()
+        if not ret:
+            break
+        
+        frame = cv2.resize(frame, (frame.shape[1] // 2, frame.shape[0] // 2))
+        results = model.track(frame, stream=True, persist=True)
+
+        for result in results:
+            classes_names = result.names
+
+            for box in result.boxes:
+                if box.conf[0] > 0.4:
+                    [x1, y1, x2, y2] = box.xyxy[0]
+                    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+
+                    cls = int(box.cls[0])
+                    class_name = classes_names[cls]
+                    
+                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                    cv2.putText(frame, f'{classes_names[int(box.cls[0])]} {box.conf[0]:.2f}', (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                    
+        cv2.imshow('frame', frame)
+
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    videoCap.release()
+    cv2.destroyAllWindows()
+
+
+def read_batches(videoCap, batch=16, stride=1, scale=0.5, cached=None):
+    """Батчи (номера кадров, кадры) для детектора: каждый stride-й кадр, уменьшенный в scale раз.
+
+    Пропущенные кадры только захватываются (grab) без декодирования; так же
+    и кадры, для которых cached(номер) истинно, - вместо них в батче None.
+    """
+    indices, frames = [], []
+    index = 0
+    while True:
+        if index % stride == 0:
+            if cached is not None and cached(index):
+                ret, frame = videoCap.grab(), None
+            else:
+                ret, frame = videoCap.read()
+                if ret and scale != 1:
+                    frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            if not ret:
+                break
+            indices.append(index)
+            frames.append(frame)
+            if len(frames) == batch:
+                yield indices, frames
+                indices, frames = [], []
+        elif not videoCap.grab():
+            break
+        index += 1
+    if frames:
+        yield indices, frames
+
+
+class TrackWriter:
+    """Колонки треков, накапливаемые по кадрам, с заполнением кадров между проходами детектора.
+
+    interpolate - линейно по трекам, найденным на обоих соседних проходах;
+    propagate - все боксы предыдущего прохода повторяются. Кадры после
+    последнего прохода не заполняются.
+    """
+
+    def __init__(self, fill="interpolate"):
+        if fill not in FILL_MODES:
+            raise ValueError(f"Unknown fill mode: {fill}. Expected one of {FILL_MODES}.")
+        self.fill = fill
+        self.columns = {name: [] for name in ("frame", "boxes", "conf", "cls", "track", "interpolated")}
+        self.previous = None
+
+    def add(self, frame, boxes, conf, cls, track):
+        """Детекции кадра детектора; кадры после предыдущего прохода заполняются по fill."""
+        if self.previous is not None:
+            self._fill(self.previous, (frame, boxes, conf, cls, track))
+        self._append(np.full(len(track), frame), boxes, conf, cls, track, False)
+        self.previous = (frame, boxes, conf, cls, track)
+
+    def _fill(self, previous, current):
+        frame_a, boxes_a, conf_a, cls_a, track_a = previous
+        frame_b, boxes_b, conf_b, _, track_b = current
+        gap = frame_b - frame_a
+        if gap <= 1:
+            return
+        steps = np.arange(1, gap)
+        if self.fill == "propagate":
+            n = len(track_a)
+            self._append(np.repeat(frame_a + steps, n), np.tile(boxes_a, (gap - 1, 1)), np.tile(conf_a, gap - 1),
+                         np.tile(cls_a, gap - 1), np.tile(track_a, gap - 1), True)
+            return
+        # Интерполируются только треки, найденные на обоих концах промежутка
+        _, a, b = np.intersect1d(track_a, track_b, return_indices=True)
+        if len(a) == 0:
+            return
+        weight = (steps / gap)[:, None, None]
+        boxes = (1 - weight) * boxes_a[a] + weight * boxes_b[b]
+        conf = (1 - weight[..., 0]) * conf_a[a] + weight[..., 0] * conf_b[b]
+        self._append(np.repeat(frame_a + steps, len(a)), boxes.reshape(-1, 4), conf.reshape(-1),
+                     np.tile(cls_a[a], gap - 1), np.tile(track_a[a], gap - 1), True)
+
+    def _append(self, frame, boxes, conf, cls, track, interpolated):
+        self.columns["frame"].append(np.asarray(frame, np.int32))
+        self.columns["boxes"].append(np.asarray(boxes, np.float32).reshape(-1, 4))
+        self.columns["conf"].append(np.asarray(conf, np.float32))
+        self.columns["cls"].append(np.asarray(cls, np.int32))
+        self.columns["track"].append(np.asarray(track, np.int32))
+        self.columns["interpolated"].append(np.full(len(track), interpolated))
+
+    def save(self, path, names=None, **metadata):
+        data = {name: np.concatenate(parts) if parts else np.empty(0) for name, parts in self.columns.items()}
+        if names is not None:
+            data["names"] = np.array([names[i] for i in sorted(names)])
+        np.savez_compressed(path, **data, **{key: np.asarray(value) for key, value in metadata.items()})
+        return len(data["frame"])
+
+
+def track_offline(videoPath, output, batch=16, stride=1, fill="interpolate", scale=0.5, conf=0.4, cache=None):
+    """Офлайн-трекинг видео батчами с записью треков в output (.npz). Возвращает число строк."""
+    videoCap = cv2.VideoCapture(videoPath)
+    fps = videoCap.get(cv2.CAP_PROP_FPS)
+    cached_model = CachedModel(model, cache, videoPath, weights, key=dict(scale=scale))
+    tracker = BoxTracker()
+    writer = TrackWriter(fill)
+    start_time = time.time()
+    processed = 0
+    for indices, frames in read_batches(videoCap, batch, stride, scale, lambda i: cached_model.cached(i, conf)):
+        results = cached_model.predict(frames, indices, conf)
+        # Результаты батча идут в порядке кадров, поэтому треки связываются последовательно
+        for index, (xyxy, confs, cls) in zip(indices, results):
+            track = tracker.update(xyxy, cls)
+            writer.add(index, xyxy / scale, confs, cls, track)
+        processed += len(frames)
+        print(f"Кадр {indices[-1]}: {processed / (time.time() - start_time):.1f} кадров детектора/с")
+    videoCap.release()
+    cached_model.close()
+
+    rows = writer.save(output, cached_model.names, fps=fps, stride=stride)
+    print(f"Записано {rows} боксов в {output} за {time.time() - start_time:.1f} с")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="YOLO tracking: live window or batched offline processing.")
+    parser.add_argument("--video", default=videoPath, help="Input video (default: VIDEO_PATH)")
+    parser.add_argument("--offline", metavar="OUTPUT", help="Process without a window and write tracks to this .npz")
+    parser.add_argument("--batch", type=int, default=16, help="Frames per detector batch")
+    parser.add_argument("--stride", type=int, default=1, help="Run the detector on every k-th frame")
+    parser.add_argument("--fill", default="interpolate", choices=FILL_MODES, help="Boxes between detector frames")
+    parser.add_argument("--scale", type=float, default=0.5, help="Frame scale for the detector")
+    parser.add_argument("--conf", type=float, default=0.4, help="Detection confidence threshold")
+    parser.add_argument("--cache", help="Detection cache directory (default: DETECTION_CACHE)")
+    parser.add_argument("--cache-size", type=float, help="Detection cache size limit, MB (default: DETECTION_CACHE_MB or 4096)")
+    args = parser.parse_args(argv)
+
+    if args.offline is None:
+        track_live(args.video)
+    else:
+        track_offline(args.video, args.offline, args.batch, args.stride, args.fill, args.scale, args.conf,
+                      open_cache(args.cache, args.cache_size))
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
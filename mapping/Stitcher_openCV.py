@@ -1,53 +1,11 @@
 import cv2
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from frames import FrameSampler
+from keyframes import KeyframeSelector
 
-path_video = 'C:\\My\\Projects\\images\\Bol2.mp4'
-cap = cv2.VideoCapture(path_video)
-pano = []
-panorama = None
-frame_count = 0  # int(cap.get(cv.CAP_PROP_FPS))
-im_list = []
-pano_list = []
-stitcher = cv2.Stitcher.create(cv2.Stitcher_SCANS)
-
-while cap.isOpened():
-    frame_count += 1
-    ret, frame = cap.read()
-
-    if not ret:
-        print("Конец видеофайла.")
-        break
-    if frame_count == 120:
-        frame_count = 0
-        frame = cv2.resize(frame, (1024, 576))
-
-        # frame = frame[int(480/4):int(480-480/4), int(854/6):int(854-854/6)]
-        im_list.append(frame)
-
-        print(f"---"*10)
-        if len(im_list) == 5:
-            status, pano = stitcher.stitch(im_list, cv2.Stitcher_SCANS)
-            if status == cv2.Stitcher_OK:
-                print("OK")
-                im_list.clear()
-                pano_list.append(pano)
-            else:
-                if status == cv2.Stitcher_ERR_NEED_MORE_IMGS:
-                    print("Недостаточно изображений для сшивания.")
-                elif status == cv2.Stitcher_ERR_HOMOGRAPHY_EST_FAIL:
-                    print("Ошибка при оценке гомографии.")
-                else:
-                    print("Ошибка во время сшивания:", status)
-                # break
-
-stitcher = cv2.Stitcher.create(cv2.Stitcher_SCANS)
-if len(im_list) > 0:
-    pano_list += im_list
-status, panorama = stitcher.stitch(pano_list, cv2.Stitcher_SCANS)
-print(len(pano_list))
-if status == cv2.Stitcher_OK:
-    print("OK Panorama")
-    cv2.imwrite(f"pano_stitch.png", panorama)
-else:
+
+def print_status(status):
     if status == cv2.Stitcher_ERR_NEED_MORE_IMGS:
         print("Недостаточно изображений для сшивания.")
     elif status == cv2.Stitcher_ERR_HOMOGRAPHY_EST_FAIL:
@@ -56,7 +14,99 @@ else:
         print("Ошибка во время сшивания:", status)
 
 
-cv2.imshow("Panorama", panorama)
-cv2.waitKey(0)
-cv2.destroyAllWindows()
+def stitch_images(images):
+    # Выполняется в процессе-воркере, поэтому stitcher создаётся на каждый вызов
+    stitcher = cv2.Stitcher.create(cv2.Stitcher_SCANS)
+    return stitcher.stitch(images)
+
+
+def merge_round(pool, items, offset):
+    """Сшивает соседние пары items[offset:] параллельно. Возвращает новый список и число удачных слияний."""
+    pairs = list(range(offset, len(items) - 1, 2))
+    results = pool.map(stitch_images, [[items[i], items[i + 1]] for i in pairs])
+    merged = items[:offset]
+    ok = 0
+    for i, (status, pano) in zip(pairs, results):
+        if status == cv2.Stitcher_OK:
+            merged.append(pano)
+            ok += 1
+        else:
+            print_status(status)
+            merged += [items[i], items[i + 1]]
+    if (len(items) - offset) % 2:
+        merged.append(items[-1])
+    return merged, ok
+
+
+def tree_stitch(frames, group_size=5, workers=None):
+    """Иерархическая сшивка.
+
+    Группы по group_size кадров сшиваются параллельно по мере чтения,
+    затем соседние частичные панорамы сливаются попарно параллельными
+    раундами. Кадры неудачной группы и обе части неудачного слияния не
+    отбрасываются: следующий раунд сдвигает разбиение на пары, и они
+    пробуются с другими соседями. Сшивка останавливается, когда остаётся
+    одна панорама или оба разбиения на пары не дали ни одного слияния.
+    Возвращает список получившихся панорам в порядке следования кадров.
+    """
+    # Кадры читаются в фоновом потоке FrameSampler, поэтому процессы запускаются через spawn, а не fork
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn")) as pool:
+        groups = []
+        futures = []
+        group = []
+        for frame in frames:
+            group.append(frame)
+            if len(group) == group_size:
+                groups.append(group)
+                futures.append(pool.submit(stitch_images, group))
+                group = []
+            print(f"---"*10)
+        if group:
+            groups.append(group)
+            futures.append(pool.submit(stitch_images, group))
+
+        items = []
+        for group, future in zip(groups, futures):
+            status, pano = future.result()
+            if status == cv2.Stitcher_OK:
+                print("OK")
+                items.append(pano)
+            else:
+                print_status(status)
+                items += group
+
+        offset = 0
+        failed_rounds = 0
+        while len(items) > 1 and failed_rounds < 2:
+            items, ok = merge_round(pool, items, offset)
+            failed_rounds = 0 if ok else failed_rounds + 1
+            offset = 1 - offset
+            print(f"Раунд слияния: {ok} удачно, осталось частей: {len(items)}")
+    return items
+
+
+if __name__ == "__main__":
+    path_video = 'C:\\My\\Projects\\images\\Bol2.mp4'
+    # Каждый 10-й кадр пробный: ключевой кадр берётся, когда перекрытие с предыдущим падает ниже 60%
+    # (не реже чем раз в 240 кадров). Пропущенные кадры не декодируются, чтение идёт в фоновом потоке.
+    # Фиксированный интервал: FrameSampler(path_video, step=120, ...) без selector
+    selector = KeyframeSelector(target_overlap=0.6, max_interval=240)
+    sampler = FrameSampler(path_video, step=10, size=(1024, 576), selector=selector)
+
+    # frame = frame[int(480/4):int(480-480/4), int(854/6):int(854-854/6)]
+    pano_list = tree_stitch(frame for frame_index, frame in sampler)
+    print("Конец видеофайла.")
+    print(len(pano_list))
+
+    if len(pano_list) == 1:
+        print("OK Panorama")
+        cv2.imwrite(f"pano_stitch.png", pano_list[0])
+    else:
+        # Несшиваемые части сохраняются по отдельности, а не теряются
+        for i, pano in enumerate(pano_list):
+            cv2.imwrite(f"pano_stitch_{i}.png", pano)
 
+    if pano_list:
+        cv2.imshow("Panorama", pano_list[0])
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
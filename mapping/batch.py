@@ -0,0 +1,257 @@
+"""Пакетное построение карт по множеству видео.
+
+Видео берутся из каталогов, списков путей (.txt) или манифестов
+(.jsonl: {"video": ..., "name": ..., параметры map_video()}), ставятся в
+локальную очередь и обрабатываются пулом процессов. Новое задание
+запускается, только если его оценка памяти укладывается в бюджет вместе
+с уже идущими и в доступную системе память. Состояние заданий, время и
+выходные файлы пишутся в index.json; повторный запуск пропускает готовые
+и продолжает упавшие и прерванные задания с их контрольных точек.
+
+    python batch.py /data/flights --out maps --jobs 4 --memory-budget 16000
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing as mp
+import os
+import shutil
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+
+from checkpoint import _replace
+from main import add_mapping_arguments, map_video, mapping_options
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".ts", ".mts")
+BASE_MB = 300  # процесс с OpenCV, признаки, очередь кадров
+CANVAS_FRAMES = 64  # полотно в памяти оценивается как столько площадей кадра
+TILE_BYTES = 512 * 512 * 4
+
+
+def available_mb():
+    """Доступная системе память в МБ или None, если узнать нельзя."""
+    if os.path.exists("/proc/meminfo"):
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.virtual_memory().available / 2**20
+
+
+def discover(inputs):
+    """Задания из каталогов, списков и манифестов: список словарей с ключами video, name и параметрами."""
+    jobs = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    jobs.append(dict(video=os.path.join(path, name)))
+        elif path.endswith(".jsonl"):
+            with open(path) as file:
+                jobs.extend(json.loads(line) for line in file if line.strip())
+        elif path.endswith(".txt"):
+            with open(path) as file:
+                jobs.extend(dict(video=line.strip()) for line in file if line.strip())
+        else:
+            jobs.append(dict(video=path))
+
+    names = set()
+    for job in jobs:
+        base = job.get("name") or os.path.splitext(os.path.basename(job["video"]))[0]
+        name, i = base, 1
+        while name in names:
+            i += 1
+            name = f"{base}_{i}"
+        names.add(name)
+        job["name"] = name
+    return jobs
+
+
+def estimate_mb(video, size=(1024, 576), tiled=False, max_resident=64):
+    """Грубая оценка пиковой памяти задания в МБ."""
+    if size is None:
+        cap = cv2.VideoCapture(video)
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        cap.release()
+    if tiled:
+        canvas = max_resident * TILE_BYTES
+    else:
+        canvas = CANVAS_FRAMES * size[0] * size[1] * 4
+    return BASE_MB + canvas / 2**20
+
+
+class ResultsIndex:
+    """index.json: состояние каждого задания по имени. Пишется только родительским процессом."""
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.jobs = json.load(file)["jobs"]
+
+    def update(self, name, **values):
+        self.jobs.setdefault(name, {}).update(values)
+        self.save()
+
+    def save(self):
+        data = json.dumps(dict(updated=time.time(), jobs=self.jobs), indent=2).encode()
+        _replace(self.path, lambda f: f.write(data))
+
+
+def run_job(job, directory, options):
+    """Одно задание в процессе пула; вывод map_video() уходит в log.txt каталога задания."""
+    os.makedirs(directory, exist_ok=True)
+    checkpoint_dir = os.path.join(directory, "checkpoint")
+    resume = os.path.exists(os.path.join(checkpoint_dir, "state.npz"))
+    options = dict(options, **{k: v for k, v in job.items() if k not in ("video", "name", "memory_mb")})
+    start = time.perf_counter()
+    with open(os.path.join(directory, "log.txt"), "a") as log, contextlib.redirect_stdout(log):
+        print(f"=== {job['video']} (resume={resume})")
+        summary = map_video(job["video"], os.path.join(directory, "panorama.png"), checkpoint_dir=checkpoint_dir,
+                            resume=resume, trace_path=os.path.join(directory, "trace.jsonl"), **options)
+    return dict(seconds=time.perf_counter() - start, resumed=resume, keyframes=summary["keyframes"],
+                failed_frames=summary["failed"], outputs=summary["outputs"],
+                stages={name: stats["total"] for name, stats in summary["stages"].items()})
+
+
+class BatchRunner:
+    """Очередь заданий с пулом процессов и допуском по памяти.
+
+    Задание допускается, если сумма оценок идущих заданий вместе с ним не
+    превышает memory_budget МБ и системе доступно не меньше его оценки
+    плюс reserve МБ. Первое задание допускается всегда, чтобы очередь не
+    встала. Задания с оценкой больше tiled_above МБ переводятся на
+    TiledCanvas в своём каталоге.
+    """
+
+    def __init__(self, out, jobs=2, memory_budget=None, reserve=1024, tiled_above=None, options=None):
+        os.makedirs(out, exist_ok=True)
+        self.out = out
+        self.jobs = jobs
+        self.memory_budget = memory_budget
+        self.reserve = reserve
+        self.tiled_above = tiled_above
+        self.options = options or {}
+        self.index = ResultsIndex(os.path.join(out, "index.json"))
+
+    def plan(self, jobs, force=False):
+        """Задания, которые нужно выполнить: новые, упавшие и прерванные (running в индексе)."""
+        queue = []
+        for job in jobs:
+            name = job["name"]
+            entry = self.index.jobs.get(name, {})
+            if entry.get("status") == "done" and not force:
+                continue
+            directory = os.path.join(self.out, name)
+            job = dict(job)
+            size = job.get("size", self.options.get("size", (1024, 576)))
+            memory = job.get("memory_mb") or estimate_mb(job["video"], size)
+            if self.tiled_above is not None and memory > self.tiled_above and "tiles" not in job:
+                job["tiles"] = os.path.join(directory, "tiles")
+                memory = estimate_mb(job["video"], size, tiled=True)
+            if force and entry.get("status") == "done":
+                # Пересборка с нуля: старая контрольная точка продолжила бы готовую карту
+                for stale in ("checkpoint", "tiles"):
+                    shutil.rmtree(os.path.join(directory, stale), ignore_errors=True)
+                entry = {}
+            self.index.update(name, video=job["video"], status="pending", directory=directory, memory_mb=memory,
+                              attempts=entry.get("attempts", 0))
+            queue.append((job, memory))
+        return queue
+
+    def run(self, jobs, force=False):
+        queue = self.plan(jobs, force)
+        running = {}
+        context = mp.get_context("spawn")
+        pool = ProcessPoolExecutor(self.jobs, mp_context=context)
+        try:
+            while queue or running:
+                while len(running) < self.jobs:
+                    admitted = self._admit(queue, running)
+                    if admitted is None:
+                        break
+                    job, memory = admitted
+                    name = job["name"]
+                    attempts = self.index.jobs[name].get("attempts", 0) + 1
+                    self.index.update(name, status="running", started=time.time(), attempts=attempts, error=None)
+                    future = pool.submit(run_job, job, self.index.jobs[name]["directory"], self.options)
+                    running[future] = (job, memory)
+                    print(f"[{name}] запущено ({memory:.0f} МБ)")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, _ = running.pop(future)
+                    self._finish(job["name"], future)
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        # Процесс пула убит (например, OOM): остальные задания пула тоже потеряны
+                        for other in running:
+                            self._finish(running[other][0]["name"], other)
+                        running.clear()
+                        pool.shutdown(cancel_futures=True)
+                        pool = ProcessPoolExecutor(self.jobs, mp_context=context)
+                        break
+        finally:
+            pool.shutdown(cancel_futures=True)
+        return self.index.jobs
+
+    def _admit(self, queue, running):
+        in_use = sum(memory for _, memory in running.values())
+        free = available_mb()
+        for i, (job, memory) in enumerate(queue):
+            if running:
+                if self.memory_budget is not None and in_use + memory > self.memory_budget:
+                    continue
+                if free is not None and free < memory + self.reserve:
+                    continue
+            return queue.pop(i)
+        return None
+
+    def _finish(self, name, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            error = "".join(traceback.format_exception_only(type(e), e)).strip()
+            self.index.update(name, status="failed", finished=time.time(), error=error)
+            print(f"[{name}] ошибка: {error}")
+            return
+        directory = self.index.jobs[name]["directory"]
+        self.index.update(name, status="done", finished=time.time(),
+                          trace=os.path.join(directory, "trace.jsonl"), **result)
+        print(f"[{name}] готово за {result['seconds']:.1f} с, ключевых кадров: {result['keyframes']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build maps for many videos with a process pool.")
+    parser.add_argument("inputs", nargs="+", help="Video files, directories, .txt lists or .jsonl manifests")
+    parser.add_argument("--out", default="maps", help="Output directory with index.json and per-video results")
+    parser.add_argument("--jobs", type=int, default=2, help="Videos mapped concurrently")
+    parser.add_argument("--memory-budget", type=float, help="Total estimated memory of running jobs, MB")
+    parser.add_argument("--reserve", type=float, default=1024, help="Memory to keep available to the system, MB")
+    parser.add_argument("--tiled-above", type=float, help="Use a disk-backed canvas for jobs estimated above this, MB")
+    parser.add_argument("--force", action="store_true", help="Rebuild videos that are already done")
+    add_mapping_arguments(parser)
+    parser.set_defaults(backend="thread")
+    args = parser.parse_args(argv)
+
+    options = mapping_options(args)
+    if options["workers"] is None:
+        options["workers"] = max(1, (os.cpu_count() or 1) // args.jobs)
+    runner = BatchRunner(args.out, args.jobs, args.memory_budget, args.reserve, args.tiled_above, options)
+    jobs = runner.run(discover(args.inputs), args.force)
+    failed = [name for name, entry in jobs.items() if entry["status"] != "done"]
+    print(f"Готово: {len(jobs) - len(failed)}, с ошибками: {len(failed)}")
+    return 1 if failed else 0
+
+
+# Пул процессов на Windows заново импортирует модуль, поэтому запуск только под __main__
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,249 @@
+"""Бенчмарк конвейера построения карты на синтетических полётах.
+
+Виртуальная камера движется над большим процедурным изображением по
+заданной траектории (translation, rotation, altitude, hover, mixed),
+кадры пишутся в видео вместе с истинными гомографиями. Каждый вариант
+конвейера запускается в отдельном процессе на одном и том же видео;
+выводятся кадры/с, пиковый RSS, время этапов и дрейф относительно
+истинных гомографий. Если средний или конечный дрейф углов какого-либо
+варианта больше --max-drift пикселей, бенчмарк завершается с ошибкой.
+
+    python benchmark.py --trajectory mixed --frames 900 --variants baseline flann adaptive
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from canvas import DenseCanvas, TiledCanvas
+from engine import MappingEngine
+from extraction import FeatureExtractor, extract_features
+from features import FeatureStore
+from frames import FrameSampler
+from keyframes import KeyframeSelector
+from matcher import Matcher
+from pipeline import map_frames
+from telemetry import Trace, peak_rss_mb
+
+FRAME_SIZE = (1024, 576)
+TRAJECTORIES = ("translation", "rotation", "altitude", "hover", "mixed")
+
+DEFAULT_VARIANT = dict(matcher="bf", blend="alpha", extractor="serial", canvas="dense", adaptive=False, guided=None)
+VARIANTS = {
+    "baseline": dict(),
+    "flann": dict(matcher="flann"),
+    "feather": dict(matcher="flann", blend="feather"),
+    "multiband": dict(matcher="flann", blend="multiband"),
+    "adaptive": dict(matcher="flann", adaptive=True),
+    "guided": dict(matcher="flann", guided=40),
+    "threads": dict(matcher="flann", extractor="thread"),
+    "processes": dict(matcher="flann", extractor="process"),
+    "tiled": dict(matcher="flann", canvas="tiled"),
+}
+
+
+def make_source(width, height, seed=0):
+    """Процедурная «местность» с текстурой на нескольких масштабах, чтобы SIFT было за что зацепиться."""
+    rng = np.random.default_rng(seed)
+    source = np.zeros((height, width, 3), np.float32)
+    for sigma, weight in ((32, 0.5), (8, 0.3), (2, 0.2)):
+        noise = rng.random((height, width, 3), dtype=np.float32)
+        source += weight * cv2.GaussianBlur(noise, (0, 0), sigma) * 255
+    source = cv2.normalize(source, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    for _ in range(width * height // 4000):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        if rng.random() < 0.5:
+            cv2.circle(source, center, int(rng.integers(4, 30)), color, -1)
+        else:
+            size = rng.integers(6, 60, 2)
+            cv2.rectangle(source, center, (center[0] + int(size[0]), center[1] + int(size[1])), color, -1)
+    return source
+
+
+def trajectory(kind, n, speed=4.0):
+    """Позы камеры (cx, cy, angle в градусах, scale) для n кадров, начиная с (0, 0)."""
+    t = np.arange(n, dtype=np.float64)
+    cx, cy = speed * t, np.zeros(n)
+    angle, scale = np.zeros(n), np.ones(n)
+    if kind == "rotation":
+        angle = 0.1 * t
+    elif kind == "altitude":
+        scale = 1 + 0.4 * np.sin(2 * np.pi * t / n)
+    elif kind == "hover":
+        # Средняя треть полёта - зависание с небольшим дрожанием
+        hover = (t > n / 3) & (t < 2 * n / 3)
+        cx = speed * np.cumsum(~hover)
+        cy = np.where(hover, 2 * np.sin(t / 5), 0)
+    elif kind == "mixed":
+        cy = 0.5 * speed * n / (2 * np.pi) * np.sin(2 * np.pi * t / n)
+        angle = 15 * np.sin(2 * np.pi * t / n)
+        scale = 1 + 0.2 * np.sin(4 * np.pi * t / n)
+    elif kind != "translation":
+        raise ValueError(f"Unknown trajectory: {kind}. Expected one of {TRAJECTORIES}.")
+    return np.stack([cx, cy, angle, scale], axis=1)
+
+
+def camera_homography(pose, frame_size=FRAME_SIZE):
+    """Истинная гомография кадр -> исходное изображение для позы камеры."""
+    cx, cy, angle, scale = pose
+    w, h = frame_size
+    a = np.deg2rad(angle)
+    R = np.array([[np.cos(a), -np.sin(a), 0], [np.sin(a), np.cos(a), 0], [0, 0, 1]])
+    S = np.diag([scale, scale, 1])
+    T_center = np.array([[1, 0, -w / 2], [0, 1, -h / 2], [0, 0, 1]])
+    T_pose = np.array([[1, 0, cx], [0, 1, cy], [0, 0, 1]])
+    return T_pose @ R @ S @ T_center
+
+
+def write_synthetic_video(path, kind, n, seed=0, fps=30, frame_size=FRAME_SIZE):
+    """Рендерит полёт в видео и возвращает истинные гомографии (n, 3, 3)."""
+    poses = trajectory(kind, n)
+    w, h = frame_size
+    margin = int(np.ceil(np.hypot(w, h) * poses[:, 3].max() / 2)) + 16
+    poses[:, 0] += margin - poses[:, 0].min()
+    poses[:, 1] += margin - poses[:, 1].min()
+    source = make_source(int(poses[:, 0].max()) + margin, int(poses[:, 1].max()) + margin, seed)
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, frame_size)
+    ground_truth = np.empty((n, 3, 3))
+    for i, pose in enumerate(poses):
+        ground_truth[i] = camera_homography(pose, frame_size)
+        writer.write(cv2.warpPerspective(source, ground_truth[i], frame_size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP))
+    writer.release()
+    return ground_truth
+
+
+def drift(homographies, ground_truth, frame_size=FRAME_SIZE):
+    """Средняя ошибка положения углов кадров (пиксели) относительно истинных гомографий."""
+    if not homographies:
+        return dict(mean=None, max=None, final=None)
+    w, h = frame_size
+    corners = np.float32([[0, 0], [0, h], [w, h], [w, 0]]).reshape(-1, 1, 2)
+    first = min(homographies)
+    to_first = np.linalg.inv(ground_truth[first])
+    errors = []
+    for index in sorted(homographies):
+        expected = cv2.perspectiveTransform(corners, to_first @ ground_truth[index])
+        actual = cv2.perspectiveTransform(corners, homographies[index])
+        errors.append(float(np.linalg.norm(expected - actual, axis=2).mean()))
+    return dict(mean=float(np.mean(errors)), max=float(np.max(errors)), final=errors[-1])
+
+
+def timed(iterable, trace, name):
+    # Время ожидания следующего элемента от предыдущего этапа (декодирование, извлечение в пуле)
+    iterator = iter(iterable)
+    while True:
+        with trace.stage(name):
+            item = next(iterator, None)
+        if item is None:
+            return
+        yield item
+
+
+def extract_serial(frames, detector, trace):
+    for index, frame in frames:
+        with trace.stage("detect", index):
+            points, descriptors = extract_features(frame, detector)
+        yield index, frame, points, descriptors
+
+
+def run_variant(name, video, ground_truth_path, workdir, step, probe_step):
+    """Прогоняет один вариант конвейера; выполняется в отдельном процессе."""
+    variant = dict(DEFAULT_VARIANT, **VARIANTS[name])
+    ground_truth = np.load(ground_truth_path)
+    trace = Trace(os.path.join(workdir, f"{name}_trace.jsonl"))
+
+    store = FeatureStore()
+    matcher = Matcher(variant["matcher"])
+    if variant["canvas"] == "tiled":
+        canvas = TiledCanvas(os.path.join(workdir, f"{name}_tiles"))
+    else:
+        canvas = DenseCanvas()
+    engine = MappingEngine(canvas, blend_mode=variant["blend"], trace=trace)
+    if variant["adaptive"]:
+        sampler = FrameSampler(video, step=probe_step, color=cv2.COLOR_BGR2BGRA, selector=KeyframeSelector(0.6),
+                               trace=trace)
+    else:
+        sampler = FrameSampler(video, step=step, color=cv2.COLOR_BGR2BGRA, trace=trace)
+
+    start = time.perf_counter()
+    frames = timed(sampler, trace, "decode_wait")
+    extractor = None
+    if variant["extractor"] == "serial":
+        items = extract_serial(frames, store.detector, trace)
+    else:
+        extractor = FeatureExtractor(backend=variant["extractor"], trace=trace)
+        items = timed(extractor.map(frames), trace, "detect_wait")
+    added = map_frames(items, engine, store, matcher, trace=trace, verbose=False, guided_radius=variant["guided"])
+    elapsed = time.perf_counter() - start
+    if extractor is not None:
+        extractor.close()
+    summary = trace.summary()
+    trace.close()
+
+    x0, y0, x1, y1 = engine.bounds if engine.bounds is not None else (0, 0, 0, 0)
+    return dict(
+        variant=name,
+        config=variant,
+        seconds=elapsed,
+        video_fps=len(ground_truth) / elapsed,
+        keyframes=added,
+        keyframes_per_s=added / elapsed,
+        peak_rss_mb=peak_rss_mb(),
+        stages={name: stats["total"] for name, stats in summary["stages"].items()},
+        trace=summary,
+        drift=drift(engine.homographies, ground_truth),
+        canvas=(x1 - x0, y1 - y0),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic-flight benchmark for the mapping pipeline.")
+    parser.add_argument("--out", default="benchmark_out", help="Directory for videos and results.json")
+    parser.add_argument("--trajectory", default="mixed", choices=TRAJECTORIES)
+    parser.add_argument("--frames", type=int, default=900)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--step", type=int, default=30, help="Fixed keyframe interval")
+    parser.add_argument("--probe-step", type=int, default=5, help="Probe interval for the adaptive selector")
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument("--max-drift", type=float, default=1.0, help="Fail if mean or final corner drift exceeds this (px)")
+    parser.add_argument("--regenerate", action="store_true", help="Re-render the synthetic video even if it exists")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    video = os.path.join(args.out, f"{args.trajectory}_{args.frames}_{args.seed}.avi")
+    ground_truth_path = video[:-4] + "_gt.npy"
+    if args.regenerate or not os.path.exists(ground_truth_path):
+        print(f"Генерация синтетического видео {video}")
+        np.save(ground_truth_path, write_synthetic_video(video, args.trajectory, args.frames, args.seed))
+
+    results = []
+    # Каждый вариант в свежем процессе, чтобы пиковый RSS и кэши не смешивались
+    context = mp.get_context("spawn")
+    for name in args.variants:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(run_variant, name, video, ground_truth_path, args.out, args.step, args.probe_step).result()
+        results.append(result)
+        stages = ", ".join(f"{k}={v:.2f}s" for k, v in sorted(result["stages"].items()))
+        drift_px = "n/a" if result["drift"]["mean"] is None else f"{result['drift']['mean']:.1f}/{result['drift']['final']:.1f} px"
+        print(f"{name:10s} {result['video_fps']:8.1f} fps  {result['keyframes']:4d} kf  "
+              f"{result['peak_rss_mb']:7.1f} MB  drift {drift_px}  {stages}")
+
+    with open(os.path.join(args.out, "results.json"), "w") as file:
+        json.dump(dict(trajectory=args.trajectory, frames=args.frames, seed=args.seed, results=results), file, indent=2)
+
+    # Ускорение не должно покупаться точностью: дрейф сверх порога - провал бенчмарка
+    drifted = [r["variant"] for r in results
+               if r["drift"]["mean"] is None or max(r["drift"]["mean"], r["drift"]["final"]) > args.max_drift]
+    if drifted:
+        raise SystemExit(f"Дрейф больше {args.max_drift} px: {', '.join(drifted)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import cv2
+import numpy as np
+
+BLEND_MODES = ("overwrite", "alpha", "feather", "multiband")
+
+
+def _max_value(dtype):
+    return np.iinfo(dtype).max
+
+
+def _wide(dtype):
+    # Промежуточный тип для произведений вида alpha * value
+    return np.uint32 if np.dtype(dtype).itemsize == 1 else np.uint64
+
+
+def _copy_new_only(dst, src):
+    # Где полотно ещё пустое, новый кадр просто копируется
+    new_only = (dst[..., 3] == 0) & (src[..., 3] > 0)
+    dst[new_only] = src[new_only]
+
+
+def feather_weights(alpha, width=64):
+    """Вес нового кадра 0..255 по расстоянию до его края (линейно на ширине width пикселей)."""
+    mask = (alpha > 0).astype(np.uint8)
+    distance = cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+    np.minimum(distance, width, out=distance)
+    return (distance * (255.0 / width)).astype(np.uint8)
+
+
+def blend_overwrite(dst, src, weight=None):
+    """Новый кадр поверх полотна."""
+    np.copyto(dst, src, where=src[..., 3:4] > 0)
+
+
+def blend_alpha(dst, src, weight=None):
+    """Полотно поверх нового кадра с учётом своей альфы (поведение исходного image_overlay)."""
+    m = _max_value(dst.dtype)
+    _copy_new_only(dst, src)
+    a_old = dst[..., 3]
+    mix = (a_old > 0) & (a_old < m) & (src[..., 3] > 0)
+    if not mix.any():
+        return
+    d = dst[mix].astype(_wide(dst.dtype))
+    s = src[mix].astype(_wide(dst.dtype))
+    a = d[:, 3:4]
+    dst[mix] = (a * d + (m - a) * s + m // 2) // m
+
+
+def blend_feather(dst, src, weight):
+    """Взвешенное по расстоянию до края смешивание на пересечении."""
+    both = (dst[..., 3] > 0) & (src[..., 3] > 0)
+    _copy_new_only(dst, src)
+    if not both.any():
+        return
+    d = dst[both].astype(_wide(dst.dtype))
+    s = src[both].astype(_wide(dst.dtype))
+    w = weight[both].astype(_wide(dst.dtype))[:, None]
+    dst[both] = (w * s + (255 - w) * d + 127) // 255
+
+
+def _laplacian_pyramid(image, levels):
+    pyramid = []
+    for _ in range(levels):
+        down = cv2.pyrDown(image)
+        up = cv2.pyrUp(down, dstsize=(image.shape[1], image.shape[0]))
+        pyramid.append(image - up)
+        image = down
+    pyramid.append(image)
+    return pyramid
+
+
+def blend_multiband(dst, src, weight, levels=4):
+    """Многополосное смешивание (пирамиды Лапласа) на ограничивающем прямоугольнике пересечения."""
+    both = (dst[..., 3] > 0) & (src[..., 3] > 0)
+    _copy_new_only(dst, src)
+    if not both.any():
+        return
+    rows = np.flatnonzero(both.any(axis=1))
+    cols = np.flatnonzero(both.any(axis=0))
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    levels = max(0, min(levels, int(np.log2(min(y1 - y0, x1 - x0))) - 1))
+
+    d = dst[y0:y1, x0:x1, :3].astype(np.float32)
+    s = src[y0:y1, x0:x1, :3].astype(np.float32)
+    w = weight[y0:y1, x0:x1].astype(np.float32) / 255
+    w[dst[y0:y1, x0:x1, 3] == 0] = 1
+    w[src[y0:y1, x0:x1, 3] == 0] = 0
+
+    blended = []
+    gauss = w
+    for level_d, level_s in zip(_laplacian_pyramid(d, levels), _laplacian_pyramid(s, levels)):
+        g = gauss[..., None]
+        blended.append(g * level_s + (1 - g) * level_d)
+        gauss = cv2.pyrDown(gauss)
+
+    image = blended[-1]
+    for level in reversed(blended[:-1]):
+        image = cv2.pyrUp(image, dstsize=(level.shape[1], level.shape[0])) + level
+    np.clip(image, 0, _max_value(dst.dtype), out=image)
+
+    region = dst[y0:y1, x0:x1]
+    overlap = both[y0:y1, x0:x1]
+    region[..., :3][overlap] = image[overlap].astype(dst.dtype)
+
+
+_BLENDERS = {
+    "overwrite": blend_overwrite,
+    "alpha": blend_alpha,
+    "feather": blend_feather,
+    "multiband": blend_multiband,
+}
+
+
+def blend(dst, src, mode="alpha", weight=None):
+    """Смешивает src в dst на месте.
+
+    dst и src - участки BGRA одного размера (uint8 или uint16); для
+    feather и multiband нужен weight из feather_weights(). Временные
+    массивы занимают не больше пересечения внутри переданного участка.
+    """
+    if mode not in _BLENDERS:
+        raise ValueError(f"Unknown blend mode: {mode}. Expected one of {BLEND_MODES}.")
+    _BLENDERS[mode](dst, src, weight)
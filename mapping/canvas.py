@@ -0,0 +1,181 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _intersect(a0, a1, b0, b1):
+    return max(a0, b0), min(a1, b1)
+
+
+class DenseCanvas:
+    """Полотно панорамы одним массивом в памяти.
+
+    Растёт только в нужную сторону и сразу с запасом в growth раз,
+    поэтому перевыделение происходит редко.
+    """
+
+    def __init__(self, channels=4, dtype=np.uint8, growth=1.5):
+        self.channels = channels
+        self.dtype = dtype
+        self.growth = growth
+        self.array = None
+        self.origin = (0, 0)  # мировые координаты пикселя (0, 0) массива
+
+    def blocks(self, x0, y0, x1, y1):
+        """Доступные для записи участки полотна, покрывающие прямоугольник.
+
+        Возвращает пары (view, (rows, cols)), где rows/cols - срезы
+        внутри прямоугольника (x0, y0, x1, y1).
+        """
+        self._ensure(x0, y0, x1, y1)
+        ox, oy = self.origin
+        view = self.array[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+        return [(view, (slice(0, y1 - y0), slice(0, x1 - x0)))]
+
+    def read(self, x0, y0, x1, y1):
+        """Содержимое прямоугольника; пустые области заполнены нулями."""
+        if self.array is not None:
+            ox, oy = self.origin
+            ch, cw = self.array.shape[:2]
+            if x0 >= ox and y0 >= oy and x1 <= ox + cw and y1 <= oy + ch:
+                return self.array[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+
+        out = np.zeros((y1 - y0, x1 - x0, self.channels), self.dtype)
+        if self.array is None:
+            return out
+        ix0, ix1 = _intersect(x0, x1, ox, ox + cw)
+        iy0, iy1 = _intersect(y0, y1, oy, oy + ch)
+        if ix0 < ix1 and iy0 < iy1:
+            out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = self.array[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox]
+        return out
+
+    @property
+    def nbytes(self):
+        return 0 if self.array is None else self.array.nbytes
+
+    def flush(self):
+        pass
+
+    def _ensure(self, x0, y0, x1, y1):
+        if self.array is None:
+            self.array = np.zeros((y1 - y0, x1 - x0, self.channels), self.dtype)
+            self.origin = (x0, y0)
+            return
+
+        ox, oy = self.origin
+        ch, cw = self.array.shape[:2]
+        if x0 >= ox and y0 >= oy and x1 <= ox + cw and y1 <= oy + ch:
+            return
+
+        nx0, nx1 = self._grow(ox, ox + cw, x0, x1)
+        ny0, ny1 = self._grow(oy, oy + ch, y0, y1)
+        array = np.zeros((ny1 - ny0, nx1 - nx0, self.channels), self.dtype)
+        array[oy - ny0:oy - ny0 + ch, ox - nx0:ox - nx0 + cw] = self.array
+        self.array = array
+        self.origin = (nx0, ny0)
+
+    def _grow(self, c0, c1, r0, r1):
+        n0, n1 = min(c0, r0), max(c1, r1)
+        if (n0, n1) == (c0, c1):
+            return n0, n1
+        extra = max(0, int((c1 - c0) * self.growth) - (n1 - n0))
+        if n0 < c0 and n1 > c1:
+            return n0 - extra // 2, n1 + extra - extra // 2
+        if n0 < c0:
+            return n0 - extra, n1
+        return n0, n1 + extra
+
+
+class TiledCanvas:
+    """Полотно панорамы из тайлов фиксированного размера на диске.
+
+    Каждый тайл - отдельный файл .npy, открываемый через numpy.memmap.
+    В памяти держится не более max_resident тайлов (LRU); вытесняемый тайл
+    сбрасывается на диск. Тайлы создаются только там, куда реально попал
+    кадр, поэтому размер карты ограничен диском, а не оперативной памятью.
+
+    Тайлы, уже лежащие в directory, подхватываются только с resume=True
+    (продолжение по контрольной точке); иначе они удаляются, чтобы новая
+    карта не смешивалась с остатками прошлого запуска.
+    """
+
+    def __init__(self, directory, tile_size=512, channels=4, dtype=np.uint8, max_resident=64, resume=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tile_size = tile_size
+        self.channels = channels
+        self.dtype = dtype
+        self.max_resident = max_resident
+        self.resident = OrderedDict()
+        self.on_disk = set()
+        for name in os.listdir(directory):
+            if name.endswith(".npy"):
+                if resume:
+                    tx, ty = name[:-4].split("_")
+                    self.on_disk.add((int(tx), int(ty)))
+                else:
+                    os.remove(os.path.join(directory, name))
+
+    def tile_path(self, key):
+        return os.path.join(self.directory, f"{key[0]}_{key[1]}.npy")
+
+    def tile(self, key, create=True):
+        """Тайл по индексу (tx, ty) или None, если его нет и create=False."""
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            return self.resident[key]
+
+        path = self.tile_path(key)
+        if key in self.on_disk:
+            tile = np.load(path, mmap_mode="r+")
+        elif create:
+            shape = (self.tile_size, self.tile_size, self.channels)
+            tile = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=shape)
+            self.on_disk.add(key)
+        else:
+            return None
+
+        self.resident[key] = tile
+        while len(self.resident) > self.max_resident:
+            _, evicted = self.resident.popitem(last=False)
+            evicted.flush()
+        return tile
+
+    def keys(self, x0, y0, x1, y1):
+        ts = self.tile_size
+        for ty in range(y0 // ts, (y1 - 1) // ts + 1):
+            for tx in range(x0 // ts, (x1 - 1) // ts + 1):
+                yield tx, ty
+
+    def blocks(self, x0, y0, x1, y1):
+        """Доступные для записи участки тайлов, покрывающие прямоугольник (см. DenseCanvas.blocks)."""
+        ts = self.tile_size
+        for tx, ty in self.keys(x0, y0, x1, y1):
+            tile = self.tile((tx, ty))
+            ix0, ix1 = _intersect(x0, x1, tx * ts, (tx + 1) * ts)
+            iy0, iy1 = _intersect(y0, y1, ty * ts, (ty + 1) * ts)
+            view = tile[iy0 - ty * ts:iy1 - ty * ts, ix0 - tx * ts:ix1 - tx * ts]
+            yield view, (slice(iy0 - y0, iy1 - y0), slice(ix0 - x0, ix1 - x0))
+
+    def read(self, x0, y0, x1, y1):
+        """Содержимое прямоугольника; отсутствующие тайлы читаются как нули."""
+        ts = self.tile_size
+        out = np.zeros((y1 - y0, x1 - x0, self.channels), self.dtype)
+        for tx, ty in self.keys(x0, y0, x1, y1):
+            tile = self.tile((tx, ty), create=False)
+            if tile is None:
+                continue
+            ix0, ix1 = _intersect(x0, x1, tx * ts, (tx + 1) * ts)
+            iy0, iy1 = _intersect(y0, y1, ty * ts, (ty + 1) * ts)
+            out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = tile[iy0 - ty * ts:iy1 - ty * ts, ix0 - tx * ts:ix1 - tx * ts]
+        return out
+
+    @property
+    def nbytes(self):
+        """Объём тайлов, отображённых в память."""
+        return len(self.resident) * self.tile_size * self.tile_size * self.channels * np.dtype(self.dtype).itemsize
+
+    def flush(self):
+        for tile in self.resident.values():
+            tile.flush()
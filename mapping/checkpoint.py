@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+from itertools import islice
+
+import cv2
+import numpy as np
+
+from canvas import DenseCanvas
+
+FORMATS = ("npy", "png")
+
+
+class Snapshot:
+    """Состояние карты, переданное фоновому писателю."""
+
+    def __init__(self, image, bounds, entries, keyframe):
+        self.image = image
+        self.bounds = bounds
+        self.entries = entries
+        self.keyframe = keyframe
+
+
+def _replace(path, write):
+    # Пишем во временный файл и атомарно подменяем: при падении остаётся предыдущая контрольная точка
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def load_homographies(path):
+    """Журнал гомографий кадр -> мир: {индекс кадра: H}."""
+    homographies = {}
+    if not os.path.exists(path):
+        return homographies
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                homographies[entry["frame"]] = np.array(entry["H"], dtype=np.float64)
+    return homographies
+
+
+def save_homographies(path, homographies):
+    """Пишет журнал гомографий {индекс кадра: H} целиком (формат load_homographies)."""
+    lines = "".join(json.dumps({"frame": int(index), "H": H.tolist()}) + "\n" for index, H in homographies.items())
+    _replace(path, lambda f: f.write(lines.encode()))
+
+
+class CheckpointWriter:
+    """Асинхронная запись контрольных точек панорамы.
+
+    submit() делает снимок в основном потоке и передаёт его фоновому
+    потоку. Если писатель не успевает, ожидающий снимок заменяется более
+    новым. Частота ограничивается min_interval секунд и площадью
+    min_changed_area пикселей, изменённой с прошлой контрольной точки.
+
+    Формат npy пишет полотно как panorama.npy, png - как panorama.png.
+    В обоих случаях рядом лежат state.npz (границы и признаки последнего
+    ключевого кадра) и журнал гомографий homographies.jsonl, чего
+    достаточно для продолжения после падения (load_checkpoint). Для
+    TiledCanvas полотно не копируется: тайлы уже на диске и только
+    сбрасываются.
+    """
+
+    def __init__(self, directory, fmt="npy", min_interval=10.0, min_changed_area=0, trace=None):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown checkpoint format: {fmt}. Expected one of {FORMATS}.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fmt = fmt
+        self.min_interval = min_interval
+        self.min_changed_area = min_changed_area
+        self.last_time = None
+        self.changed_area = 0
+        self.logged = 0
+        self.coalesced = 0
+        self.trace = trace
+        self.pending = None
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, engine, store, area=0, force=False):
+        """Ставит контрольную точку, если позволяют ограничения. Возвращает True, если снимок сделан."""
+        self.changed_area += area
+        now = time.monotonic()
+        if not force and self.last_time is not None:
+            if now - self.last_time < self.min_interval or self.changed_area < self.min_changed_area:
+                return False
+        if engine.bounds is None:
+            return False
+
+        snapshot = self._snapshot(engine, store)
+        with self.condition:
+            if self.pending is not None:
+                # Старый снимок не записан: оставляем только новый, но не теряем записи журнала
+                snapshot.entries = self.pending.entries + snapshot.entries
+                self.coalesced += 1
+            self.pending = snapshot
+            self.condition.notify()
+        self.last_time = now
+        self.changed_area = 0
+        return True
+
+    def restore(self, engine, store):
+        """Продолжение после падения: загружает контрольную точку из directory (см. load_checkpoint)."""
+        frame_index = load_checkpoint(self.directory, engine, store)
+        self.logged = len(engine.homographies)
+        return frame_index
+
+    def close(self, engine=None, store=None):
+        """Записывает финальную контрольную точку и останавливает поток."""
+        if engine is not None:
+            self.submit(engine, store, force=True)
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _snapshot(self, engine, store):
+        image = None
+        if isinstance(engine.canvas, DenseCanvas):
+            image = engine.result().copy()
+        else:
+            engine.canvas.flush()
+        entries = list(islice(engine.homographies.items(), self.logged, None))
+        self.logged += len(entries)
+        last = store.last()
+        keyframe = None if last is None else (last.index, last.points, last.descriptors, last.H)
+        return Snapshot(image, engine.bounds, entries, keyframe)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                snapshot, self.pending = self.pending, None
+            if snapshot is None:
+                return
+            try:
+                start = time.perf_counter()
+                self._write(snapshot)
+                if self.trace is not None:
+                    frame = None if snapshot.keyframe is None else int(snapshot.keyframe[0])
+                    self.trace.event("write", seconds=time.perf_counter() - start, frame=frame, coalesced=self.coalesced)
+            except Exception as e:
+                print("Ошибка записи контрольной точки:", e)
+                self.error = e
+
+    def _write(self, snapshot):
+        if snapshot.image is not None:
+            if self.fmt == "npy":
+                _replace(self.path("panorama.npy"), lambda f: np.save(f, snapshot.image))
+            else:
+                ok, encoded = cv2.imencode(".png", snapshot.image)
+                if not ok:
+                    raise IOError("PNG encoding failed.")
+                _replace(self.path("panorama.png"), lambda f: f.write(encoded.tobytes()))
+
+        with open(self.path("homographies.jsonl"), "a") as file:
+            for index, H in snapshot.entries:
+                file.write(json.dumps({"frame": int(index), "H": H.tolist()}) + "\n")
+
+        # state.npz пишется последним и фиксирует контрольную точку
+        state = dict(bounds=np.array(snapshot.bounds, dtype=np.int64))
+        if snapshot.keyframe is not None:
+            index, points, descriptors, H = snapshot.keyframe
+            state.update(frame_index=index, points=points, descriptors=descriptors, H=H)
+        _replace(self.path("state.npz"), lambda f: np.savez(f, **state))
+
+
+def load_checkpoint(directory, engine, store):
+    """Восстанавливает engine и store из контрольной точки. Возвращает индекс последнего ключевого кадра или None."""
+    state_path = os.path.join(directory, "state.npz")
+    if not os.path.exists(state_path):
+        return None
+    state = np.load(state_path)
+    bounds = tuple(int(v) for v in state["bounds"])
+
+    image = None
+    if os.path.exists(os.path.join(directory, "panorama.npy")):
+        image = np.load(os.path.join(directory, "panorama.npy"))
+    elif os.path.exists(os.path.join(directory, "panorama.png")):
+        image = cv2.imread(os.path.join(directory, "panorama.png"), cv2.IMREAD_UNCHANGED)
+    if image is not None:
+        for view, (rows, cols) in engine.canvas.blocks(*bounds):
+            view[:] = image[rows, cols]
+    engine.bounds = bounds
+
+    if "frame_index" not in state:
+        return None
+    frame_index = int(state["frame_index"])
+    homographies = load_homographies(os.path.join(directory, "homographies.jsonl"))
+    engine.homographies = {i: H for i, H in homographies.items() if i <= frame_index}
+    store.add(frame_index, state["points"], state["descriptors"], state["H"])
+    return frame_index
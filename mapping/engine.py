@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+
+from blending import blend, feather_weights
+from canvas import DenseCanvas
+from telemetry import stage
+
+
+def translation(tx, ty):
+    return np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]], dtype=np.float64)
+
+
+def footprint(shape, H):
+    """Ограничивающий прямоугольник кадра после гомографии H: (x0, y0, x1, y1)."""
+    h, w = shape[:2]
+    corners = np.float32([[0, 0], [0, h], [w, h], [w, 0]]).reshape(-1, 1, 2)
+    warped_corners = cv2.perspectiveTransform(corners, H).reshape(-1, 2)
+    [x0, y0] = np.floor(warped_corners.min(axis=0)).astype(np.int64)
+    [x1, y1] = np.ceil(warped_corners.max(axis=0)).astype(np.int64)
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+class MappingEngine:
+    """Панорама в постоянной мировой системе координат.
+
+    Мировые координаты совпадают с координатами первого кадра. Для каждого
+    кадра хранится накопленная гомография кадр -> мир. Новый кадр
+    варпится только в прямоугольник своих спроецированных углов и
+    смешивается на месте (blend_mode, см. blending.py) только с теми
+    участками полотна (DenseCanvas или TiledCanvas), которые этот
+    прямоугольник покрывает.
+    """
+
+    def __init__(self, canvas=None, blend_mode="alpha", feather_width=64, max_footprint_scale=16, trace=None):
+        self.canvas = canvas if canvas is not None else DenseCanvas()
+        self.blend_mode = blend_mode
+        self.feather_width = feather_width
+        self.max_footprint_scale = max_footprint_scale
+        self.bounds = None  # заполненная область в мировых координатах (x0, y0, x1, y1)
+        self.homographies = {}
+        self.trace = trace
+
+    def add(self, index, frame, H):
+        """Добавляет кадр с гомографией H (кадр -> мир). Возвращает его ROI в мировых координатах."""
+        h, w = frame.shape[:2]
+        x0, y0, x1, y1 = footprint(frame.shape, H)
+        if (x1 - x0) * (y1 - y0) > self.max_footprint_scale * w * h:
+            raise ValueError("Degenerate homography: frame footprint is too large.")
+
+        with stage(self.trace, "warp"):
+            patch = cv2.warpPerspective(frame, translation(-x0, -y0) @ H, (x1 - x0, y1 - y0))
+        with stage(self.trace, "blend"):
+            weight = None
+            if self.blend_mode in ("feather", "multiband"):
+                weight = feather_weights(patch[:, :, 3], self.feather_width)
+            for view, (rows, cols) in self.canvas.blocks(x0, y0, x1, y1):
+                blend(view, patch[rows, cols], self.blend_mode, None if weight is None else weight[rows, cols])
+
+        if self.bounds is None:
+            self.bounds = (x0, y0, x1, y1)
+        else:
+            bx0, by0, bx1, by1 = self.bounds
+            self.bounds = (min(bx0, x0), min(by0, y0), max(bx1, x1), max(by1, y1))
+        self.homographies[index] = H
+        return x0, y0, x1, y1
+
+    def result(self):
+        """Заполненная часть полотна одним массивом.
+
+        Для TiledCanvas собирает всю карту в память; для больших карт
+        читайте нужные области через canvas.read().
+        """
+        if self.bounds is None:
+            return None
+        return self.canvas.read(*self.bounds)
@@ -0,0 +1,136 @@
+import multiprocessing as mp
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+DETECTORS = ("sift", "orb")
+
+_worker = threading.local()
+
+
+def keypoints_to_points(keypoints):
+    """Координаты ключевых точек массивом (N, 2) float32."""
+    if len(keypoints) == 0:
+        return np.empty((0, 2), np.float32)
+    return cv2.KeyPoint_convert(keypoints).reshape(-1, 2)
+
+
+def create_detector(name="sift"):
+    if name == "sift":
+        return cv2.SIFT_create()
+    if name == "orb":
+        return cv2.ORB_create(nfeatures=5000)
+    raise ValueError(f"Unknown detector: {name}. Expected one of {DETECTORS}.")
+
+
+def to_gray(frame, scale=1.0):
+    """Серый кадр, уменьшенный в scale раз (scale <= 1)."""
+    if frame.ndim == 3:
+        code = cv2.COLOR_BGRA2GRAY if frame.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        frame = cv2.cvtColor(frame, code)
+    if scale != 1:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def upscale_points(points, scale):
+    """Точки уменьшенного в scale раз кадра в координатах исходного кадра."""
+    if scale == 1:
+        return points
+    return (points + 0.5) / scale - 0.5
+
+
+def extract_features(frame, detector, scale=1.0, mask=None):
+    """Ключевые точки (N, 2) float32 и дескрипторы одного кадра.
+
+    С scale < 1 признаки ищутся на уменьшенном кадре, а точки
+    возвращаются в координатах исходного. mask (uint8 размера кадра)
+    ограничивает область поиска.
+    """
+    gray = to_gray(frame, scale)
+    if mask is not None and mask.shape != gray.shape:
+        mask = cv2.resize(mask, gray.shape[::-1], interpolation=cv2.INTER_NEAREST)
+    keypoints, descriptors = detector.detectAndCompute(gray, mask)
+    return upscale_points(keypoints_to_points(keypoints), scale), descriptors
+
+
+def _init_worker(detector_name):
+    _worker.detector = create_detector(detector_name)
+
+
+def _extract_in_worker(frame, detector_name):
+    # У каждого процесса/потока свой детектор, создаётся один раз
+    if getattr(_worker, "detector", None) is None:
+        _init_worker(detector_name)
+    start = time.perf_counter()
+    points, descriptors = extract_features(frame, _worker.detector)
+    return points, descriptors, time.perf_counter() - start
+
+
+class FeatureExtractor:
+    """Параллельное извлечение признаков с выдачей в порядке кадров.
+
+    Кадры отправляются в пул процессов (backend="process") или потоков
+    (backend="thread": OpenCV отпускает GIL внутри detectAndCompute).
+    Одновременно в работе не больше max_pending кадров, результаты
+    возвращаются строго в порядке поступления в виде компактных
+    массивов точек и дескрипторов. С trace время detect в воркере
+    записывается на соответствующий кадр.
+
+    С scale < 1 в воркер уходит уменьшенный серый кадр (дешевле
+    передавать между процессами), точки возвращаются в координатах
+    исходного кадра (см. extract_features).
+    """
+
+    def __init__(self, workers=None, detector="sift", backend="process", max_pending=None, scale=1.0, trace=None):
+        if detector not in DETECTORS:
+            raise ValueError(f"Unknown detector: {detector}. Expected one of {DETECTORS}.")
+        self.workers = workers or os.cpu_count() or 1
+        self.detector = detector
+        self.max_pending = max_pending or 2 * self.workers
+        self.scale = scale
+        self.trace = trace
+        if backend == "process":
+            # Пул создаётся при работающем потоке чтения кадров: fork такого процесса может зависнуть
+            context = mp.get_context("spawn")
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker,
+                                            initargs=(detector,))
+        elif backend == "thread":
+            self.pool = ThreadPoolExecutor(self.workers)
+        else:
+            raise ValueError(f"Unknown extractor backend: {backend}. Expected 'process' or 'thread'.")
+
+    def map(self, frames):
+        """Принимает (index, frame), выдаёт (index, frame, points, descriptors) в том же порядке."""
+        pending = deque()
+        try:
+            for index, frame in frames:
+                small = frame if self.scale == 1 else to_gray(frame, self.scale)
+                pending.append((index, frame, self.pool.submit(_extract_in_worker, small, self.detector)))
+                if len(pending) >= self.max_pending:
+                    yield self._result(*pending.popleft())
+            while pending:
+                yield self._result(*pending.popleft())
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+    def _result(self, index, frame, future):
+        points, descriptors, seconds = future.result()
+        if self.trace is not None:
+            self.trace.record(index, "detect", seconds)
+        return index, frame, upscale_points(points, self.scale), descriptors
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,40 @@
+from collections import deque
+
+from extraction import create_detector, extract_features
+
+
+class Keyframe:
+    """Признаки одного сырого кадра и его накопленная гомография в координаты панорамы."""
+
+    def __init__(self, index, points, descriptors, H, image=None):
+        self.index = index
+        self.points = points
+        self.descriptors = descriptors
+        self.H = H
+        self.image = image  # уменьшенный серый кадр для уточнения гомографии (см. registration.py)
+
+
+class FeatureStore:
+    """Хранилище признаков ключевых кадров.
+
+    SIFT считается один раз на каждый выбранный кадр исходного размера,
+    а не на растущем полотне панорамы, поэтому стоимость сопоставления
+    не зависит от размера карты. С scale < 1 признаки ищутся на
+    уменьшенном кадре, а точки хранятся в координатах исходного.
+    """
+
+    def __init__(self, detector=None, max_keyframes=8, scale=1.0):
+        self.detector = detector if detector is not None else create_detector("sift")
+        self.keyframes = deque(maxlen=max_keyframes)
+        self.scale = scale
+
+    def compute(self, frame, mask=None):
+        return extract_features(frame, self.detector, self.scale, mask)
+
+    def add(self, index, points, descriptors, H, image=None):
+        keyframe = Keyframe(index, points, descriptors, H, image)
+        self.keyframes.append(keyframe)
+        return keyframe
+
+    def last(self):
+        return self.keyframes[-1] if self.keyframes else None
@@ -0,0 +1,130 @@
+import queue
+import threading
+import time
+
+import cv2
+
+_END = object()
+
+
+class FrameSampler:
+    """Источник кадров для построения карты.
+
+    Берёт из видео каждый step-й кадр (индексы offset, offset + step, ...).
+    Пропускаемые кадры только grab()-аются без декодирования в изображение
+    (или перематываются через CAP_PROP_POS_FRAMES при seek=True), нужные
+    retrieve()-ятся, уменьшаются до size и переводятся в цвет color.
+    Чтение идёт в отдельном потоке с ограниченной очередью, поэтому
+    декодирование выполняется параллельно с сопоставлением и варпингом.
+
+    С selector (KeyframeSelector) step задаёт шаг пробных кадров, а в
+    очередь попадают только выбранные по движению ключевые кадры.
+
+    С trace (telemetry.Trace) время decode (вместе с пропущенными
+    кадрами), convert и select записывается на выданный кадр.
+    """
+
+    def __init__(self, path, step=120, size=None, color=None, offset=None, seek=False, queue_size=8, selector=None,
+                 trace=None):
+        self.path = path
+        self.step = step
+        self.size = size
+        self.color = color
+        self.offset = step - 1 if offset is None else offset
+        self.seek = seek
+        self.selector = selector
+        self.trace = trace
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.error = None
+        self.thread = None
+
+    def __iter__(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _END:
+                    break
+                yield item
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.stop.set()
+        # Освобождаем место в очереди, чтобы поток не завис на put()
+        while self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def prepare(self, frame):
+        if self.size is not None:
+            frame = cv2.resize(frame, self.size)
+        if self.color is not None:
+            frame = cv2.cvtColor(frame, self.color)
+        return frame
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        cap = cv2.VideoCapture(self.path)
+        try:
+            if not cap.isOpened():
+                raise IOError(f"Cannot open video: {self.path}")
+            index = -1
+            target = self.offset
+            decode = convert = select = 0.0
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                if self.seek and target - index > 1:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+                    index = target - 1
+                if not cap.grab():
+                    break
+                index += 1
+                if index < target:
+                    decode += time.perf_counter() - start
+                    continue
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                decode += time.perf_counter() - start
+                target += self.step
+
+                start = time.perf_counter()
+                frame = self.prepare(frame)
+                convert += time.perf_counter() - start
+                start = time.perf_counter()
+                items = [(index, frame)] if self.selector is None else self.selector.update(index, frame)
+                select += time.perf_counter() - start
+                if items:
+                    if self.trace is not None:
+                        # Пробные кадры, не ставшие ключевыми, оплачивает следующий выданный кадр
+                        key = items[-1][0]
+                        self.trace.record(key, "decode", decode)
+                        self.trace.record(key, "convert", convert)
+                        if self.selector is not None:
+                            self.trace.record(key, "select", select)
+                    decode = convert = select = 0.0
+                if not all(self._put(item) for item in items):
+                    break
+            if self.selector is not None and not self.stop.is_set():
+                for item in self.selector.flush():
+                    self._put(item)
+        except Exception as e:
+            self.error = e
+        finally:
+            cap.release()
+            self._put(_END)
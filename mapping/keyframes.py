@@ -0,0 +1,78 @@
+import cv2
+import numpy as np
+
+
+def to_small_gray(frame, width):
+    """Сильно уменьшенный серый кадр float32 для быстрой оценки движения."""
+    if frame.ndim == 3:
+        code = cv2.COLOR_BGRA2GRAY if frame.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        frame = cv2.cvtColor(frame, code)
+    h, w = frame.shape[:2]
+    small = cv2.resize(frame, (width, max(1, round(h * width / w))), interpolation=cv2.INTER_AREA)
+    return small.astype(np.float32)
+
+
+class KeyframeSelector:
+    """Выбор ключевых кадров по движению камеры.
+
+    Смещение между соседними пробными кадрами оценивается фазовой
+    корреляцией на уменьшенных до width пикселей серых кадрах и
+    накапливается от последнего ключевого кадра. Ключевой кадр выдаётся,
+    когда оценка перекрытия с последним ключевым кадром падает ниже
+    target_overlap. Если корреляция теряется (response < min_response),
+    выдаются предыдущий пробный кадр - последний, ещё перекрывающийся с
+    картой, - и текущий. max_interval ограничивает число кадров между ключевыми:
+    повороты и смена высоты фазовой корреляцией не оцениваются.
+    """
+
+    def __init__(self, target_overlap=0.6, width=160, min_response=0.05, max_interval=None):
+        self.target_overlap = target_overlap
+        self.width = width
+        self.min_response = min_response
+        self.max_interval = max_interval
+        self.window = None
+        self.last_key_index = None
+        self.prev = None  # (index, frame, small) предыдущего пробного кадра
+        self.prev_emitted = False
+        self.shift = np.zeros(2)
+
+    def overlap(self):
+        h, w = self.window.shape
+        return max(0.0, 1 - abs(self.shift[0]) / w) * max(0.0, 1 - abs(self.shift[1]) / h)
+
+    def update(self, index, frame):
+        """Принимает очередной пробный кадр, возвращает список выбранных ключевых кадров (index, frame)."""
+        small = to_small_gray(frame, self.width)
+        if self.window is None:
+            self.window = cv2.createHanningWindow(small.shape[::-1], cv2.CV_32F)
+
+        keyframes = []
+        if self.prev is None:
+            keyframes.append(self._emit(index, frame))
+        else:
+            (dx, dy), response = cv2.phaseCorrelate(self.prev[2], small, self.window)
+            if response < self.min_response:
+                if not self.prev_emitted:
+                    keyframes.append(self._emit(self.prev[0], self.prev[1]))
+                keyframes.append(self._emit(index, frame))
+            else:
+                self.shift += (dx, dy)
+                too_long = self.max_interval is not None and index - self.last_key_index >= self.max_interval
+                if self.overlap() < self.target_overlap or too_long:
+                    keyframes.append(self._emit(index, frame))
+
+        self.prev_emitted = bool(keyframes) and keyframes[-1][0] == index
+        self.prev = (index, frame, small)
+        return keyframes
+
+    def flush(self):
+        """Последний пробный кадр в конце видео, если он ещё не выдан."""
+        if self.prev is None or self.prev_emitted:
+            return []
+        self.prev_emitted = True
+        return [self._emit(self.prev[0], self.prev[1])]
+
+    def _emit(self, index, frame):
+        self.last_key_index = index
+        self.shift[:] = 0
+        return index, frame
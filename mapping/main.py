@@ -1,8 +1,23 @@
+import argparse
+import os
+
 import cv2
 from PIL import Image
 import  math
 from decimal import *
-import numpy as np
+from blending import BLEND_MODES
+from extraction import DETECTORS, FeatureExtractor, create_detector
+from features import FeatureStore
+from matcher import BACKENDS, Matcher
+from engine import MappingEngine, translation
+from canvas import DenseCanvas, TiledCanvas
+from frames import FrameSampler
+from keyframes import KeyframeSelector
+from checkpoint import CheckpointWriter, save_homographies
+from registration import HomographyRefiner
+from pyramid import TilePyramid
+from pipeline import PanoramaBuilder
+from telemetry import Trace
 
 def rgba_to_grayscale_with_alpha(img):
     # Проверяем, что изображение имеет 4 канала (RGBA)
@@ -35,152 +50,166 @@ def rgba_to_grayscale_with_alpha(img):
 #     # image = rgba_to_grayscale_with_alpha(image)
 #     return image
 
-def detect_and_match_features(img1, img2):
-    # orb = cv2.ORB_create()
-    # keypoints1, descriptors1 = orb.detectAndCompute(img1, None)
-    # keypoints2, descriptors2 = orb.detectAndCompute(img2, None)
-    #
-    # bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-    # matches = bf.match(descriptors1, descriptors2)
-    # matches = sorted(matches, key=lambda x: x.distance)
-
-    sift = cv2.SIFT_create()
-    keypoints1, des1 = sift.detectAndCompute(img1, None)
-    keypoints2, des2 = sift.detectAndCompute(img2, None)
-
-    bf = cv2.BFMatcher()
-    matches = bf.knnMatch(des2, des1, k=2)
-
-    good = []
-    for m, n in matches:
-        if m.distance < 0.4 * n.distance:
-            good.append(m)
-
-    return keypoints1, keypoints2, good
-
-def estimate_homography(keypoints1, keypoints2, matches, threshold=3):
-    src_points = np.float32([keypoints2[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_points = np.float32([keypoints1[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-    if len(src_points) < 4 and len(dst_points) < 4:
-        raise Exception("err")
-    print(f"src:{len(src_points)}, dst:{len(dst_points)}")
-
-    H, mask = cv2.findHomography(src_points, dst_points, cv2.RANSAC, threshold)
-
-    return H, mask
-
-def warp_images(img1, img2, H):
-    h1, w1 = img1.shape[:2]
-    h2, w2 = img2.shape[:2]
-    # print(f"{h1=} {w1=}")
-    # cv2.imshow("img_new undo", img2)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
-
-    corners1 = np.float32([[0, 0], [0, h1], [w1, h1], [w1, 0]]).reshape(-1, 1, 2)
-    corners2 = np.float32([[0, 0], [0, h2], [w2, h2], [w2, 0]]).reshape(-1, 1, 2)
-    warped_corners2 = cv2.perspectiveTransform(corners2, H)
-
-    corners = np.concatenate((corners1, warped_corners2), axis=0)
-    [xmin, ymin] = np.int32(corners.min(axis=0).ravel() - 0.5)
-    [xmax, ymax] = np.int32(corners.max(axis=0).ravel() + 0.5)
-
-    t = [-xmin, -ymin]
-    Ht = np.array([[1, 0, t[0]], [0, 1, t[1]], [0, 0, 1]])
-    # Ht_temp = np.array([[1, 0, t_all[0]], [0, 1, t_all[1]], [0, 0, 1]])
-    #
-    # warped_img2_tmp = cv2.warpPerspective(img2, Ht_temp @ H, (xmax, ymax))
-    warped_img2 = cv2.warpPerspective(img2, Ht @ H, (xmax - xmin, ymax - ymin))
-    # cv2.imshow("img_new after", warped_img2)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
-
-    # cv2.imshow("img_temp", warped_img2_tmp)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
-
-    return warped_img2, t
-
-def image_overlay(image, warped_img, t):
-    h1, w1 = image.shape[:2]
-
-    # Назначаем альфа-канал
-    alpha_channel = image[:, :, 3] / 255.0  # Преобразуем 0-255 в 0-1
-
-    # image = transparent_edges()
-
-    # cv2.imshow("image", warped_img)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
-
-    # Наложение warped_img2 и image
-    for c in range(4):  # Для каждого канала (R, G, B)
-        warped_img[t[1]:h1 + t[1], t[0]:w1 + t[0], c] = (
-                alpha_channel * image[:, :, c] +
-                (1 - alpha_channel) * warped_img[t[1]:h1 + t[1], t[0]:w1 + t[0], c]
-        )
-    # print(warped_img2.shape)
-    # cv2.imshow("Panorama", warped_img)
-    # cv2.waitKey(0)
-    # cv2.destroyAllWindows()
-
-    return warped_img
-
-
-
-path_video = 'C:\\My\\Projects\\images\\Bol2.mp4'
-cap = cv2.VideoCapture(path_video)
-pano = []
-image_prev = []
-image_new = []
-frame_count = 0  # int(cap.get(cv.CAP_PROP_FPS))
-# t_all = [0, 0]
-stitcher = cv2.Stitcher.create(cv2.Stitcher_SCANS)
-
-while cap.isOpened():
-    frame_count += 1
-    ret, frame = cap.read()
-
-    if not ret:
-        print("Конец видеофайла.")
-        break
-    if frame_count == 120:
-        frame_count = 0
-        frame = cv2.resize(frame, (1024, 576))
-        # frame = frame[int(480/4):int(480-480/4), int(854/6):int(854-854/6)]
-
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
-        # frame = rgba_to_grayscale_with_alpha(frame)
-        if len(pano) == 0 and len(image_prev) == 0:
-            print("new pano")
-            pano = frame.copy()
-            cv2.imwrite(f"panorama.png", frame)
-            image_prev = frame.copy()
-            continue
-
-        image_new = frame.copy()
-
-        print(f"---"*10)
-
-        keypoints1, keypoints2, matches = detect_and_match_features(image_prev, image_new)
-        print(f"kp1 {len(keypoints1)}, kp2 {len(keypoints2)}")
-
-        try:
-            H, mask = estimate_homography(keypoints1, keypoints2, matches)
-        except Exception:
-            continue
-
-        image_new, t_add = warp_images(image_prev, image_new, H)
-        # t_all = [t_all[i] + t_add[i] for i in range(2)]
-
-        image_prev = image_new.copy()
-
-        pano = image_overlay(pano, image_prev, t_add)
-
-        cv2.imwrite(f"panorama.png", pano)
-
-
-cv2.imshow("Panorama", pano)
-cv2.waitKey(0)
-cv2.destroyAllWindows()
-
+def write_map(engine, output, strip_height=4096):
+    """Пишет карту в output. Возвращает список записанных файлов.
+
+    Полотно в памяти пишется одним изображением. TiledCanvas целиком в
+    память не собирается: карта пишется горизонтальными полосами по
+    strip_height строк в {output без расширения}_strip_{k}{расширение},
+    полоса k начинается со строки k * strip_height карты.
+    """
+    if engine.bounds is None:
+        return []
+    if isinstance(engine.canvas, DenseCanvas):
+        cv2.imwrite(output, engine.result())
+        return [output]
+    stem, ext = os.path.splitext(output)
+    x0, y0, x1, y1 = engine.bounds
+    paths = []
+    for k, y in enumerate(range(y0, y1, strip_height)):
+        path = f"{stem}_strip_{k:03d}{ext}"
+        cv2.imwrite(path, engine.canvas.read(x0, y, x1, min(y + strip_height, y1)))
+        paths.append(path)
+    return paths
+
+
+def map_video(path_video, output="panorama.png", step=10, size=(1024, 576), overlap=0.6, max_interval=240,
+              matcher="flann", detector=None, blend_mode="alpha", tiles=None, checkpoint_dir=None, checkpoint_interval=10.0,
+              resume=False, backend="process", workers=None, detect_scale=1.0, refine_scale=None, guided_radius=None,
+              pyramid_dir=None, tile_size=256, trace_path=None, verbose=False):
+    """Строит карту по видео и пишет её в output. Возвращает итоги трассировки (Trace.summary())
+    с добавленным списком записанных изображений карты outputs.
+
+    С tiles карта пишется полосами (см. write_map). Рядом с картой
+    пишется {output без расширения}_homographies.jsonl с гомографиями
+    ключевых кадров в пиксели всей карты.
+
+    Каждый step-й кадр пробный: ключевой кадр берётся, когда перекрытие с
+    предыдущим падает ниже overlap (не реже чем раз в max_interval кадров;
+    overlap=None - каждый пробный кадр ключевой). Пропущенные кадры не
+    декодируются, чтение идёт в фоновом потоке, SIFT для следующих кадров
+    считается в пуле (backend, workers), пока текущий сопоставляется и варпится.
+    tiles - каталог для TiledCanvas вместо полотна в памяти; тайлы прошлого
+    запуска в нём используются только с resume, иначе удаляются.
+    detector - "sift" или "orb"; по умолчанию ORB для matcher="lsh"
+    (LSH работает только с бинарными дескрипторами) и SIFT для остальных.
+
+    Для карт полного разрешения (size=None): признаки ищутся на кадре,
+    уменьшенном в detect_scale раз, гомография уточняется по яркости на
+    масштабе refine_scale (если задан), варпится исходный кадр.
+    guided_radius включает направляемое сопоставление (см. PanoramaBuilder).
+    pyramid_dir - каталог пирамиды тайлов, обновляемой после каждого ключевого кадра.
+    """
+    # Время этапов и счётчики по каждому ключевому кадру (JSON lines), итоги с перцентилями в конце
+    trace = Trace(trace_path)
+    if detector is None:
+        detector = "orb" if matcher == "lsh" else "sift"
+    # Признаки считаются один раз на сырой кадр и хранятся вместе с его гомографией в панораму
+    store = FeatureStore(create_detector(detector), scale=detect_scale)
+    # Панорама в мировых координатах первого кадра; новый кадр варпится только в свой ROI
+    canvas = DenseCanvas() if tiles is None else TiledCanvas(tiles, resume=resume)
+    engine = MappingEngine(canvas, blend_mode=blend_mode, trace=trace)
+    # Контрольные точки пишутся в фоне не чаще раза в checkpoint_interval секунд
+    checkpoints = None
+    last_index = None
+    if checkpoint_dir is not None:
+        checkpoints = CheckpointWriter(checkpoint_dir, fmt="npy", min_interval=checkpoint_interval, trace=trace)
+        last_index = checkpoints.restore(engine, store) if resume else None
+    pyramid = None
+    if pyramid_dir is not None:
+        pyramid = TilePyramid(pyramid_dir, tile_size)
+        if engine.bounds is not None:
+            # После продолжения перерисовываем всё: изменения после последнего обновления не сохранились
+            pyramid.mark(*engine.bounds)
+    refiner = None if refine_scale is None else HomographyRefiner(refine_scale)
+    builder = PanoramaBuilder(engine, store, Matcher(matcher), checkpoints, trace, refiner=refiner,
+                              guided_radius=guided_radius, pyramid=pyramid, verbose=verbose)
+
+    selector = None if overlap is None else KeyframeSelector(target_overlap=overlap, max_interval=max_interval)
+    sampler = FrameSampler(path_video, step=step, size=size, color=cv2.COLOR_BGR2BGRA, selector=selector,
+                           offset=None if last_index is None else last_index + step, trace=trace)
+    with FeatureExtractor(workers=workers, detector=detector, backend=backend, scale=detect_scale, trace=trace) as extractor:
+        for item in extractor.map(sampler):
+            builder.add_features(*item)
+
+    print("Конец видеофайла.")
+    builder.close()
+    with trace.timed("write"):
+        outputs = write_map(engine, output)
+    if outputs:
+        # Гомографии кадр -> пиксели карты нужны для переноса детекций на карту (см. spatial_index.py)
+        to_image = translation(-engine.bounds[0], -engine.bounds[1])
+        save_homographies(os.path.splitext(output)[0] + "_homographies.jsonl",
+                          {index: to_image @ H for index, H in engine.homographies.items()})
+    summary = trace.print_summary()
+    trace.close()
+    summary["outputs"] = outputs
+    return summary
+
+
+def parse_size(value):
+    if value == "full":
+        return None
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def add_mapping_arguments(parser):
+    """Параметры построения карты, общие для main.py и batch.py."""
+    parser.add_argument("--step", type=int, default=10, help="Probe every N-th frame")
+    parser.add_argument("--size", type=parse_size, default=(1024, 576), help="Frame size WxH before mapping or 'full'")
+    parser.add_argument("--detect-scale", type=float, default=1.0, help="Detect features on a frame downscaled by this factor")
+    parser.add_argument("--refine-scale", type=float, help="Refine homographies with ECC at this scale")
+    parser.add_argument("--overlap", type=float, default=0.6, help="Target overlap between keyframes")
+    parser.add_argument("--fixed-step", action="store_true", help="Use every probed frame as a keyframe")
+    parser.add_argument("--max-interval", type=int, default=240, help="Force a keyframe at least every N frames")
+    parser.add_argument("--matcher", default="flann", choices=BACKENDS)
+    parser.add_argument("--detector", choices=DETECTORS, help="Feature detector (default: orb for lsh, sift otherwise)")
+    parser.add_argument("--blend", default="alpha", choices=BLEND_MODES)
+    parser.add_argument("--checkpoint-interval", type=float, default=10.0, help="Seconds between checkpoints")
+    parser.add_argument("--guided-radius", type=float, help="Match only within this radius (px) of the motion prior")
+    parser.add_argument("--backend", default="process", choices=("process", "thread"))
+    parser.add_argument("--workers", type=int, help="Feature extraction workers")
+
+
+def mapping_options(args):
+    """Аргументы map_video() из параметров add_mapping_arguments()."""
+    return dict(step=args.step, size=args.size, overlap=None if args.fixed_step else args.overlap,
+                max_interval=args.max_interval, matcher=args.matcher, detector=args.detector, blend_mode=args.blend,
+                checkpoint_interval=args.checkpoint_interval, backend=args.backend, workers=args.workers,
+                detect_scale=args.detect_scale, refine_scale=args.refine_scale, guided_radius=args.guided_radius)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a map (panorama) from a drone video.")
+    parser.add_argument("video", help="Input video file")
+    parser.add_argument("-o", "--output", default="panorama.png",
+                        help="Output image; with --tiles written as horizontal strips {stem}_strip_{k}{ext}. "
+                             "Frame homographies go to {stem}_homographies.jsonl")
+    add_mapping_arguments(parser)
+    parser.add_argument("--tiles", help="Directory for a disk-backed tiled canvas (cleared unless --resume)")
+    parser.add_argument("--checkpoint", help="Directory for periodic checkpoints")
+    parser.add_argument("--resume", action="store_true", help="Continue from the checkpoint directory")
+    parser.add_argument("--pyramid", help="Directory for a live zoomable tile pyramid ({z}/{x}/{y}.png)")
+    parser.add_argument("--tile-size", type=int, default=256, help="Pyramid tile size")
+    parser.add_argument("--trace", help="Write per-keyframe timings as JSON lines")
+    parser.add_argument("--show", action="store_true", help="Show the result in a window (not with --tiles)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires --checkpoint")
+    if args.show and args.tiles is not None:
+        parser.error("--show is not supported with --tiles: the map is written in strips")
+
+    map_video(args.video, args.output, tiles=args.tiles, checkpoint_dir=args.checkpoint, resume=args.resume,
+              pyramid_dir=args.pyramid, tile_size=args.tile_size, trace_path=args.trace, verbose=args.verbose, **mapping_options(args))
+
+    if args.show:
+        cv2.imshow("Panorama", cv2.imread(args.output, cv2.IMREAD_UNCHANGED))
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+
+# Пул процессов на Windows заново импортирует модуль, поэтому запуск только под __main__
+if __name__ == "__main__":
+    main()
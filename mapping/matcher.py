@@ -0,0 +1,186 @@
+import cv2
+import numpy as np
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+BACKENDS = ("bf", "flann", "lsh")
+
+
+class Matches:
+    """Результат сопоставления в виде массивов индексов и расстояний."""
+
+    def __init__(self, query_idx, train_idx, distance):
+        self.query_idx = query_idx
+        self.train_idx = train_idx
+        self.distance = distance
+
+    def __len__(self):
+        return len(self.query_idx)
+
+    @staticmethod
+    def empty():
+        return Matches(np.empty(0, np.intp), np.empty(0, np.intp), np.empty(0, np.float32))
+
+
+class GridIndex:
+    """Сетка с ячейками cell пикселей над ключевыми точками для поиска соседей в радиусе cell."""
+
+    def __init__(self, points, cell):
+        self.points = np.asarray(points, np.float32).reshape(-1, 2)
+        self.cell = float(cell)
+        cells = np.floor(self.points / self.cell).astype(np.int64)
+        self.order = np.lexsort((cells[:, 0], cells[:, 1]))
+        self.keys = self._key(cells[self.order])
+
+    @staticmethod
+    def _key(cells):
+        # Ячейки (cx, cy) в одно целое по строкам; 2**20 ячеек по оси хватает с запасом
+        return (cells[..., 1] + 2**20) * 2**21 + (cells[..., 0] + 2**20)
+
+    def neighbourhoods(self, points):
+        """Группы (индексы points, индексы точек сетки из соседних 3x3 ячеек) по ячейкам points."""
+        points = np.asarray(points, np.float32).reshape(-1, 2)
+        cells = np.floor(points / self.cell).astype(np.int64)
+        keys = self._key(cells)
+        order = np.argsort(keys, kind="stable")
+        unique, starts = np.unique(keys[order], return_index=True)
+        bounds = np.append(starts, len(order))
+        first = cells[order[starts]]
+        # Ячейки одной строки сетки идут подряд, поэтому соседи - три непрерывных диапазона
+        ranges = []
+        for dy in (-1, 0, 1):
+            lo = np.searchsorted(self.keys, self._key(first + (-1, dy)), "left")
+            hi = np.searchsorted(self.keys, self._key(first + (1, dy)), "right")
+            ranges.append((lo, hi))
+        for i in range(len(unique)):
+            train = np.concatenate([self.order[lo[i]:hi[i]] for lo, hi in ranges])
+            yield order[bounds[i]:bounds[i + 1]], train
+
+    def region(self, x0, y0, x1, y1):
+        """Индексы точек из ячеек, пересекающих прямоугольник (точную проверку делает вызывающий)."""
+        cx0, cy0, cx1, cy1 = (int(np.floor(v / self.cell)) for v in (x0, y0, x1, y1))
+        rows = np.arange(cy0, cy1 + 1)
+        lo = np.searchsorted(self.keys, self._key(np.stack([np.full_like(rows, cx0), rows], axis=1)), "left")
+        hi = np.searchsorted(self.keys, self._key(np.stack([np.full_like(rows, cx1), rows], axis=1)), "right")
+        count = hi - lo
+        # Диапазоны [lo, hi) по строкам сетки в один массив без цикла
+        offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        return self.order[np.repeat(lo, count) + offsets]
+
+
+class Matcher:
+    """Сопоставление дескрипторов с выбираемым бэкендом.
+
+    bf    - полный перебор (L2 для SIFT, Хэмминг для бинарных дескрипторов);
+    flann - KD-деревья FLANN для вещественных дескрипторов (SIFT);
+    lsh   - FLANN LSH для бинарных дескрипторов (ORB, BRISK).
+
+    Поиск двух ближайших соседей возвращается массивами NumPy,
+    поэтому тест Лоу выполняется векторно.
+
+    match_guided() сравнивает дескрипторы только с кандидатами в радиусе
+    от предсказанного положения точки (GridIndex); бэкенд при этом не
+    используется, а тест Лоу идёт с более мягким guided_ratio.
+    """
+
+    def __init__(self, backend="bf", ratio=0.4, trees=5, checks=50, guided_ratio=0.6):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown matcher backend: {backend}. Expected one of {BACKENDS}.")
+        self.backend = backend
+        self.ratio = ratio
+        self.trees = trees
+        self.checks = checks
+        self.guided_ratio = guided_ratio
+
+    def check(self, descriptors):
+        """Проверяет, что бэкенд подходит для дескрипторов: LSH работает только с бинарными."""
+        if self.backend == "lsh" and descriptors is not None and descriptors.dtype != np.uint8:
+            raise ValueError("lsh requires binary (uint8) descriptors")
+
+    def knn(self, des_query, des_train):
+        self.check(des_train)
+        if self.backend == "bf":
+            if des_train.dtype == np.uint8:
+                dist, idx = cv2.batchDistance(des_query, des_train, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=2)
+            else:
+                dist, idx = cv2.batchDistance(des_query, des_train, cv2.CV_32F, normType=cv2.NORM_L2, K=2)
+            return idx, dist.astype(np.float32)
+
+        if self.backend == "flann":
+            params = dict(algorithm=FLANN_INDEX_KDTREE, trees=self.trees)
+            des_query = np.asarray(des_query, np.float32)
+            des_train = np.asarray(des_train, np.float32)
+        else:
+            params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+        index = cv2.flann_Index(des_train, params)
+        idx, dist = index.knnSearch(des_query, 2, params=dict(checks=self.checks))
+        dist = dist.astype(np.float32)
+        if self.backend == "flann":
+            # KD-дерево возвращает квадраты расстояний
+            np.sqrt(dist, out=dist)
+        return idx, dist
+
+    def match(self, des_query, des_train):
+        if des_query is None or des_train is None or len(des_query) == 0 or len(des_train) < 2:
+            return Matches.empty()
+
+        idx, dist = self.knn(des_query, des_train)
+        # LSH может не найти соседа и вернуть -1
+        good = (idx >= 0).all(axis=1) & (dist[:, 0] < self.ratio * dist[:, 1])
+        query_idx = np.flatnonzero(good)
+        return Matches(query_idx, idx[good, 0].astype(np.intp), dist[good, 0])
+
+    def match_guided(self, des_query, des_train, predicted, points_train, radius):
+        """Сопоставление с пространственным ограничением.
+
+        predicted - положения точек запроса, перенесённые в координаты
+        кадра train по предсказанной гомографии. Кандидаты - точки train
+        не дальше radius; тест Лоу - по двум лучшим кандидатам, точка с
+        единственным кандидатом принимается. Расстояния считаются блоками
+        «ячейка сетки x соседние ячейки» через матричное умножение.
+        """
+        if des_query is None or des_train is None or len(des_query) == 0 or len(des_train) == 0:
+            return Matches.empty()
+
+        predicted = np.asarray(predicted, np.float32).reshape(-1, 2)
+        points_train = np.asarray(points_train, np.float32).reshape(-1, 2)
+        binary = des_train.dtype == np.uint8
+        if binary:
+            bits_query, bits_train = np.unpackbits(des_query, axis=1), np.unpackbits(des_train, axis=1)
+            des_query, des_train = bits_query.astype(np.float32), bits_train.astype(np.float32)
+        else:
+            des_query, des_train = np.asarray(des_query, np.float32), np.asarray(des_train, np.float32)
+        norm_query = np.einsum("ij,ij->i", des_query, des_query)
+        norm_train = np.einsum("ij,ij->i", des_train, des_train)
+
+        n = len(des_query)
+        best = np.full(n, -1, np.intp)
+        best_dist = np.full(n, np.inf, np.float32)
+        second_dist = np.full(n, np.inf, np.float32)
+        for query, train in GridIndex(points_train, radius).neighbourhoods(predicted):
+            if len(train) == 0:
+                continue
+            # Квадраты расстояний L2; для бинарных дескрипторов на битах это расстояние Хэмминга
+            dist = norm_query[query, None] + norm_train[None, train] - 2 * des_query[query] @ des_train[train].T
+            offset = predicted[query, None] - points_train[None, train]
+            dist[np.einsum("ijk,ijk->ij", offset, offset) > radius * radius] = np.inf
+            rows = np.arange(len(query))
+            if len(train) > 1:
+                nearest = np.argpartition(dist, 1, axis=1)[:, :2]
+                d0, d1 = dist[rows, nearest[:, 0]], dist[rows, nearest[:, 1]]
+                swap = d1 < d0
+                nearest[swap] = nearest[swap, ::-1]
+                d0, d1 = np.minimum(d0, d1), np.maximum(d0, d1)
+            else:
+                nearest = np.zeros((len(query), 1), np.intp)
+                d0, d1 = dist[:, 0], np.full(len(query), np.inf, np.float32)
+            best[query] = train[nearest[:, 0]]
+            best_dist[query], second_dist[query] = d0, d1
+
+        np.maximum(best_dist, 0, out=best_dist)
+        best_dist = best_dist if binary else np.sqrt(best_dist)
+        second_dist = second_dist if binary else np.sqrt(np.maximum(second_dist, 0))
+        good = np.isfinite(best_dist) & (best_dist < self.guided_ratio * second_dist)
+        query_idx = np.flatnonzero(good)
+        return Matches(query_idx, best[good], best_dist[good])
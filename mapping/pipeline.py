@@ -0,0 +1,290 @@
+import cv2
+import numpy as np
+
+from canvas import DenseCanvas
+from engine import MappingEngine
+from features import FeatureStore
+from matcher import Matcher
+from telemetry import stage
+
+
+def estimate_homography(points1, points2, matches, threshold=3):
+    src_points = points2[matches.query_idx].reshape(-1, 1, 2)
+    dst_points = points1[matches.train_idx].reshape(-1, 1, 2)
+    if len(src_points) < 4 or len(dst_points) < 4:
+        raise Exception("err")
+
+    H, mask = cv2.findHomography(src_points, dst_points, cv2.RANSAC, threshold)
+    if H is None:
+        raise Exception("err")
+
+    return H, mask
+
+
+class PanoramaBuilder:
+    """Потоковое построение карты из уже декодированных кадров.
+
+    add_frame() принимает очередной кадр видео (например, тот же кадр,
+    что идёт в детекцию), сам прореживает их через step и selector
+    (KeyframeSelector), приводит к size и BGRA, считает признаки и
+    добавляет ключевой кадр в engine. add_features() - то же для кадра
+    с уже посчитанными признаками (FeatureExtractor.map()). result()
+    возвращает текущую карту, close() добирает последний кадр селектора
+    и пишет финальную контрольную точку.
+
+    Режим «грубо-точно»: признаки ищутся на уменьшенном кадре
+    (FeatureStore(scale=...) или FeatureExtractor(scale=...)), гомография
+    при необходимости уточняется refiner (HomographyRefiner) в полосе
+    перекрытия, а в карту варпится кадр исходного разрешения. Порог
+    RANSAC по умолчанию пересчитывается в пиксели исходного кадра.
+
+    С guided_radius включено направляемое сопоставление: относительная
+    гомография прошлой пары ключевых кадров, пересчитанная на число кадров
+    между ключевыми (модель постоянной скорости), предсказывает положение
+    точек нового кадра на предыдущем, и
+    дескрипторы сравниваются только с точками в радиусе guided_radius
+    пикселей (Matcher.match_guided). Предсказание грубое при повороте и
+    смене масштаба, поэтому результат принимается, только если инлаеров
+    не меньше min_guided_matches и не меньше доли min_guided_share от
+    инлаеров последнего полного сопоставления; иначе кадр сопоставляется
+    полным перебором. В add_frame() детектор к тому же ограничивается
+    предсказанными перекрытиями с предыдущим и следующим кадрами.
+
+    С pyramid (pyramid.TilePyramid) после каждого ключевого кадра
+    перерисовываются тайлы пирамиды, которых коснулся его ROI.
+    """
+
+    def __init__(self, engine=None, store=None, matcher=None, checkpoints=None, trace=None, step=1, size=None,
+                 selector=None, refiner=None, ransac_threshold=None, guided_radius=None, min_guided_matches=30,
+                 min_guided_share=0.5, pyramid=None, verbose=False):
+        self.engine = engine if engine is not None else MappingEngine(trace=trace)
+        self.store = store if store is not None else FeatureStore()
+        self.matcher = matcher if matcher is not None else Matcher("flann")
+        self.checkpoints = checkpoints
+        self.trace = trace
+        self.step = step
+        self.size = size
+        self.selector = selector
+        self.refiner = refiner
+        self.ransac_threshold = ransac_threshold if ransac_threshold is not None else 3 / self.store.scale
+        self.guided_radius = guided_radius
+        self.min_guided_matches = min_guided_matches
+        self.min_guided_share = min_guided_share
+        self.full_inliers = None  # инлаеры последнего полного сопоставления
+        self.motion = None  # последняя относительная гомография: новый ключевой кадр -> предыдущий
+        self.motion_frames = 1  # число кадров видео, за которое произошло это движение
+        self.pyramid = pyramid
+        self.verbose = verbose
+        self.next_index = 0
+        self.added = 0
+
+    def add_frame(self, frame, index=None):
+        """Очередной кадр видео (BGR или BGRA). Возвращает число добавленных ключевых кадров."""
+        if index is None:
+            index = self.next_index
+        self.next_index = index + 1
+        # Те же индексы, что у FrameSampler по умолчанию: step - 1, 2 * step - 1, ...
+        if (index + 1) % self.step:
+            return 0
+
+        frame = self.prepare(frame)
+        if self.selector is None:
+            keyframes = [(index, frame)]
+        else:
+            with stage(self.trace, "select", index):
+                keyframes = self.selector.update(index, frame)
+        return sum(self._detect_and_add(i, f) for i, f in keyframes)
+
+    def prepare(self, frame):
+        if self.size is not None and frame.shape[1::-1] != tuple(self.size):
+            frame = cv2.resize(frame, self.size)
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGRA)
+        elif frame.shape[2] == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+        return frame
+
+    def add_features(self, frame_index, frame, points_new, des_new):
+        """Добавляет кадр с посчитанными признаками. Возвращает True, если кадр лёг на карту."""
+        engine, store = self.engine, self.store
+        # Неподходящий бэкенд - ошибка настройки, а не неудачная регистрация кадра
+        self.matcher.check(des_new)
+        image = None if self.refiner is None else self.refiner.prepare(frame)
+        if store.last() is None:
+            if self.verbose:
+                print("new pano")
+            roi = engine.add(frame_index, frame, np.eye(3))
+            store.add(frame_index, points_new, des_new, np.eye(3), image)
+            self.added += 1
+            self._update_pyramid(roi)
+            if self.checkpoints is not None:
+                with stage(self.trace, "snapshot"):
+                    self.checkpoints.submit(engine, store)
+            _end_frame(self.trace, frame_index, engine, "ok", keypoints=len(points_new))
+            return True
+
+        if self.verbose:
+            print("---" * 10)
+
+        keyframe_prev = store.last()
+        counters = dict(keypoints=len(points_new))
+        try:
+            H = self._register(frame_index, keyframe_prev, points_new, des_new, counters)
+            if image is not None and keyframe_prev.image is not None:
+                with stage(self.trace, "refine"):
+                    H, correlation = self.refiner.refine(keyframe_prev.image, image, H)
+                counters.update(refined=correlation is not None, correlation=correlation)
+            relative = H
+            # Накопленная гомография нового кадра в мировые координаты
+            H = keyframe_prev.H @ H
+            x0, y0, x1, y1 = engine.add(frame_index, frame, H)
+        except Exception:
+            _end_frame(self.trace, frame_index, engine, "failed", **counters)
+            return False
+
+        store.add(frame_index, points_new, des_new, H, image)
+        self.motion = relative
+        self.motion_frames = max(1, frame_index - keyframe_prev.index)
+        self.added += 1
+        self._update_pyramid((x0, y0, x1, y1))
+
+        if self.checkpoints is not None:
+            with stage(self.trace, "snapshot"):
+                self.checkpoints.submit(engine, store, area=(x1 - x0) * (y1 - y0))
+        _end_frame(self.trace, frame_index, engine, "ok", **counters)
+        return True
+
+    def result(self):
+        return self.engine.result()
+
+    def close(self):
+        """Добирает последний кадр селектора и пишет финальную контрольную точку.
+
+        Возвращает карту для полотна в памяти; TiledCanvas целиком не
+        собирается (None), его читают по частям (см. main.write_map).
+        """
+        if self.selector is not None:
+            for index, frame in self.selector.flush():
+                self._detect_and_add(index, frame)
+            self.selector = None
+        if self.checkpoints is not None:
+            self.checkpoints.close(self.engine, self.store)
+            self.checkpoints = None
+        if self.pyramid is not None:
+            with stage(self.trace, "pyramid"):
+                self.pyramid.close(self.engine.canvas)
+            self.pyramid = None
+        if not isinstance(self.engine.canvas, DenseCanvas):
+            return None
+        return self.result()
+
+    def detection_mask(self, frame_index, shape, max_coverage=0.9):
+        """Маска области детекции кадра по предсказанному движению или None, если она почти весь кадр.
+
+        Точки ключевого кадра нужны в перекрытии с предыдущим кадром (для
+        сопоставления сейчас) и со следующим (для сопоставления потом).
+        """
+        prior = self._prior(frame_index)
+        if prior is None:
+            return None
+        h, w = shape[:2]
+        corners = np.float32([[0, 0], [0, h], [w, h], [w, 0]]).reshape(-1, 1, 2)
+        mask = np.zeros((h, w), np.uint8)
+        margin = 2 * int(np.ceil(self.guided_radius))
+        for H in (np.linalg.inv(prior), prior):
+            polygon = np.round(cv2.perspectiveTransform(corners, H)).astype(np.int32)
+            cv2.fillConvexPoly(mask, polygon, 255)
+            cv2.polylines(mask, [polygon], True, 255, margin)
+        if cv2.countNonZero(mask) > max_coverage * h * w:
+            return None
+        return mask
+
+    def _update_pyramid(self, roi):
+        if self.pyramid is None:
+            return
+        self.pyramid.mark(*roi)
+        with stage(self.trace, "pyramid"):
+            tiles = self.pyramid.update(self.engine.canvas)
+        if self.trace is not None:
+            self.trace.count(tiles=tiles)
+
+    def _prior(self, frame_index):
+        """Предсказанная гомография кадр frame_index -> последний ключевой кадр или None."""
+        last = self.store.last()
+        if self.guided_radius is None or self.motion is None or last is None:
+            return None
+        # Линейная интерполяция от единичной матрицы точна для сдвига и годится для малых поворотов
+        ratio = (frame_index - last.index) / self.motion_frames
+        prior = np.eye(3) + (self.motion / self.motion[2, 2] - np.eye(3)) * ratio
+        return prior / prior[2, 2]
+
+    def _register(self, frame_index, keyframe_prev, points_new, des_new, counters):
+        # Гомография новый кадр -> предыдущий; сначала направляемое сопоставление, при неудаче - полное
+        prior = self._prior(frame_index)
+        if prior is not None and len(points_new):
+            with stage(self.trace, "match"):
+                predicted = cv2.perspectiveTransform(points_new.reshape(-1, 1, 2).astype(np.float32), prior)
+                matches = self.matcher.match_guided(des_new, keyframe_prev.descriptors, predicted.reshape(-1, 2),
+                                                    keyframe_prev.points, self.guided_radius)
+            if len(matches) >= self._min_guided_inliers():
+                try:
+                    with stage(self.trace, "ransac"):
+                        H, mask = estimate_homography(keyframe_prev.points, points_new, matches,
+                                                      self.ransac_threshold)
+                    if mask.sum() >= self._min_guided_inliers():
+                        self._count_matches(counters, matches, mask, guided=True)
+                        return H
+                except Exception:
+                    pass
+
+        with stage(self.trace, "match"):
+            matches = self.matcher.match(des_new, keyframe_prev.descriptors)
+        if self.verbose:
+            print(f"kp1 {len(keyframe_prev.points)}, kp2 {len(points_new)}")
+            print(f"src:{len(matches)}, dst:{len(matches)}")
+        counters.update(matches=len(matches), guided=False)
+        with stage(self.trace, "ransac"):
+            H, mask = estimate_homography(keyframe_prev.points, points_new, matches, self.ransac_threshold)
+        self._count_matches(counters, matches, mask, guided=False)
+        self.full_inliers = int(mask.sum())
+        return H
+
+    def _min_guided_inliers(self):
+        # Разреженное направляемое сопоставление копит дрейф: инлаеров должно быть сравнимо с полным
+        if self.full_inliers is None:
+            return self.min_guided_matches
+        return max(self.min_guided_matches, self.min_guided_share * self.full_inliers)
+
+    @staticmethod
+    def _count_matches(counters, matches, mask, guided):
+        inliers = int(mask.sum())
+        counters.update(matches=len(matches), inliers=inliers, inlier_ratio=inliers / len(matches), guided=guided)
+
+    def _detect_and_add(self, index, frame):
+        with stage(self.trace, "detect", index):
+            points, descriptors = self.store.compute(frame, self.detection_mask(index, frame.shape))
+        return self.add_features(index, frame, points, descriptors)
+
+
+def map_frames(items, engine, store, matcher, checkpoints=None, trace=None, verbose=True, guided_radius=None):
+    """Основной цикл построения карты.
+
+    items - кортежи (index, frame, points, descriptors), например из
+    FeatureExtractor.map(). Каждый кадр сопоставляется с последним
+    ключевым кадром из store, его накопленная гомография добавляется в
+    engine (см. PanoramaBuilder.add_features). С trace (telemetry.Trace)
+    для каждого кадра пишутся время match, ransac, snapshot и счётчики
+    точек, совпадений и инлаеров. Возвращает число добавленных кадров.
+    """
+    builder = PanoramaBuilder(engine, store, matcher, checkpoints, trace, guided_radius=guided_radius, verbose=verbose)
+    for item in items:
+        builder.add_features(*item)
+    return builder.added
+
+
+def _end_frame(trace, frame_index, engine, status, **counters):
+    if trace is None:
+        return
+    bx0, by0, bx1, by1 = engine.bounds if engine.bounds is not None else (0, 0, 0, 0)
+    trace.end_frame(frame_index, status=status, map_width=bx1 - bx0, map_height=by1 - by0,
+                    canvas_mb=engine.canvas.nbytes / 2**20, **counters)
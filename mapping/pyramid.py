@@ -0,0 +1,153 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from checkpoint import _replace
+
+TILE_FORMATS = ("png", "webp")
+
+
+class TilePyramid:
+    """Пирамида тайлов панорамы для просмотра с масштабированием, обновляемая по ходу построения.
+
+    Уровень 0 - полное разрешение, каждый следующий вдвое меньше. Тайл
+    уровня z с индексом (x, y) покрывает мировой прямоугольник
+    [x * s, (x + 1) * s) x [y * s, (y + 1) * s), s = tile_size * 2**z, и
+    лежит в {directory}/{z}/{x}/{y}.{fmt}; индексы могут быть
+    отрицательными (мировые координаты - координаты первого кадра).
+    Границы карты пишутся в pyramid.json.
+
+    mark() запоминает изменённую область (ROI кадра), update() не чаще
+    раза в min_interval секунд перерисовывает только затронутые тайлы:
+    уровень 0 читается из полотна, следующие собираются из четырёх
+    дочерних тайлов. Кодирование и запись идут в пуле потоков и
+    перекрываются со следующим кадром; последние max_cached тайлов
+    держатся в памяти, чтобы не декодировать соседей с диска.
+    """
+
+    def __init__(self, directory, tile_size=256, levels=6, fmt="png", min_interval=0.0, workers=4, max_cached=512):
+        if fmt not in TILE_FORMATS:
+            raise ValueError(f"Unknown tile format: {fmt}. Expected one of {TILE_FORMATS}.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tile_size = tile_size
+        self.levels = levels
+        self.fmt = fmt
+        self.min_interval = min_interval
+        self.last_time = None
+        self.dirty = set()
+        self.bounds = None
+        metadata = os.path.join(directory, "pyramid.json")
+        if os.path.exists(metadata):
+            with open(metadata) as file:
+                self.bounds = tuple(json.load(file)["bounds"])
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = []
+        self.cache = OrderedDict()
+        self.max_cached = max_cached
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.directory, str(z), str(x), f"{y}.{self.fmt}")
+
+    def mark(self, x0, y0, x1, y1):
+        """Отмечает изменённый прямоугольник в мировых координатах."""
+        ts = self.tile_size
+        for ty in range(y0 // ts, (y1 - 1) // ts + 1):
+            for tx in range(x0 // ts, (x1 - 1) // ts + 1):
+                self.dirty.add((tx, ty))
+        if self.bounds is None:
+            self.bounds = (x0, y0, x1, y1)
+        else:
+            bx0, by0, bx1, by1 = self.bounds
+            self.bounds = (min(bx0, x0), min(by0, y0), max(bx1, x1), max(by1, y1))
+
+    def update(self, canvas, force=False):
+        """Перерисовывает тайлы, затронутые с прошлого обновления. Возвращает число записанных тайлов."""
+        now = time.monotonic()
+        if not self.dirty or (not force and self.last_time is not None and now - self.last_time < self.min_interval):
+            return 0
+        self.last_time = now
+        self.wait()
+
+        ts = self.tile_size
+        level = {}
+        for tx, ty in self.dirty:
+            # Копия: полотно изменится, пока тайл ещё кодируется
+            level[tx, ty] = np.array(canvas.read(tx * ts, ty * ts, (tx + 1) * ts, (ty + 1) * ts))
+        self.dirty = set()
+
+        for z in range(self.levels):
+            if z > 0:
+                level = self._downsample(z, level)
+            for (x, y), tile in level.items():
+                if tile[:, :, 3].any():
+                    self._remember((z, x, y), tile)
+                    self.pending.append(self.pool.submit(self._write, z, x, y, tile))
+        self._write_metadata()
+        return len(self.pending)
+
+    def wait(self):
+        """Дожидается записи тайлов предыдущего обновления."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self, canvas=None):
+        """Финальное обновление (если передано полотно), ожидание записи и остановка пула."""
+        if canvas is not None:
+            self.update(canvas, force=True)
+        self.wait()
+        self.pool.shutdown()
+
+    def _downsample(self, z, children):
+        # Родитель собирается из четырёх дочерних тайлов; отсутствующие берутся с диска или пустыми
+        ts = self.tile_size
+        parents = {}
+        for x, y in {(x // 2, y // 2) for x, y in children}:
+            mosaic = np.zeros((2 * ts, 2 * ts, 4), np.uint8)
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    key = (2 * x + dx, 2 * y + dy)
+                    child = children.get(key)
+                    if child is None:
+                        child = self._read(z - 1, *key)
+                    if child is not None:
+                        mosaic[dy * ts:(dy + 1) * ts, dx * ts:(dx + 1) * ts] = child
+            parents[x, y] = cv2.resize(mosaic, (ts, ts), interpolation=cv2.INTER_AREA)
+        return parents
+
+    def _read(self, z, x, y):
+        if (z, x, y) in self.cache:
+            self.cache.move_to_end((z, x, y))
+            return self.cache[z, x, y]
+        path = self.tile_path(z, x, y)
+        if not os.path.exists(path):
+            return None
+        tile = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        self._remember((z, x, y), tile)
+        return tile
+
+    def _remember(self, key, tile):
+        self.cache[key] = tile
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+    def _write(self, z, x, y, tile):
+        path = self.tile_path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 3] if self.fmt == "png" else [cv2.IMWRITE_WEBP_QUALITY, 101]
+        ok, encoded = cv2.imencode("." + self.fmt, tile, params)
+        if not ok:
+            raise IOError(f"Tile encoding failed: {path}")
+        _replace(path, lambda f: f.write(encoded.tobytes()))
+
+    def _write_metadata(self):
+        data = json.dumps(dict(tile_size=self.tile_size, levels=self.levels, format=self.fmt,
+                               bounds=[int(v) for v in self.bounds])).encode()
+        _replace(os.path.join(self.directory, "pyramid.json"), lambda f: f.write(data))
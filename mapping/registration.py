@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+from engine import footprint, translation
+from extraction import to_gray
+
+
+def scale_matrix(scale):
+    """Переход из координат кадра в координаты кадра, уменьшенного в scale раз (центры пикселей)."""
+    offset = 0.5 * scale - 0.5
+    return np.array([[scale, 0, offset], [0, scale, offset], [0, 0, 1]], dtype=np.float64)
+
+
+def scale_homography(H, scale):
+    """Гомография между кадрами, пересчитанная для кадров, уменьшенных в scale раз."""
+    S = scale_matrix(scale)
+    return S @ H @ np.linalg.inv(S)
+
+
+class HomographyRefiner:
+    """Уточнение гомографии между соседними ключевыми кадрами по яркости (ECC).
+
+    Гомография, найденная по признакам на уменьшенном кадре, уточняется
+    cv2.findTransformECC на кадрах масштаба scale, но только в полосе
+    перекрытия нового кадра с предыдущим. Результат отбрасывается, если
+    корреляция ниже min_correlation или углы кадра сдвинулись больше
+    чем на max_shift пикселей исходного размера.
+    """
+
+    def __init__(self, scale=0.5, iterations=50, eps=1e-4, min_correlation=0.6, max_shift=16.0, min_band=64):
+        self.scale = scale
+        self.criteria = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, iterations, eps)
+        self.min_correlation = min_correlation
+        self.max_shift = max_shift
+        self.min_band = min_band
+
+    def prepare(self, frame):
+        """Уменьшенный серый кадр float32, который хранится вместе с ключевым кадром."""
+        return to_gray(frame, self.scale).astype(np.float32)
+
+    def refine(self, prev_image, image, H):
+        """H (новый кадр -> предыдущий) после уточнения и корреляция; (H, None), если уточнить не удалось."""
+        h, w = image.shape[:2]
+        H_small = scale_homography(H, self.scale)
+        # Полоса перекрытия: предыдущий кадр в координатах нового
+        x0, y0, x1, y1 = footprint(prev_image.shape, np.linalg.inv(H_small))
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+        if x1 - x0 < self.min_band or y1 - y0 < self.min_band:
+            return H, None
+
+        warp = (H_small @ translation(x0, y0)).astype(np.float32)
+        try:
+            rho, warp = cv2.findTransformECC(image[y0:y1, x0:x1], prev_image, warp, cv2.MOTION_HOMOGRAPHY,
+                                             self.criteria, None, 5)
+        except cv2.error:
+            return H, None
+        if rho < self.min_correlation:
+            return H, None
+
+        S = scale_matrix(self.scale)
+        refined = np.linalg.inv(S) @ warp.astype(np.float64) @ translation(-x0, -y0) @ S
+        refined /= refined[2, 2]
+        corners = np.float64([[0, 0], [0, h], [w, h], [w, 0]]).reshape(-1, 1, 2) / self.scale
+        shift = cv2.perspectiveTransform(corners, refined) - cv2.perspectiveTransform(corners, H)
+        if np.linalg.norm(shift, axis=2).max() > self.max_shift:
+            return H, None
+        return refined, float(rho)
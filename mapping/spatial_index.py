@@ -0,0 +1,470 @@
+"""Пространственный индекс детекций в координатах карты.
+
+Рамки детекций (x1, y1, x2, y2 в пикселях кадра) переносятся на карту
+через гомографии ключевых кадров из {карта}_homographies.jsonl (для
+промежуточных кадров гомография интерполируется) и складываются в
+сеточный индекс по центрам рамок. Поддерживаются запросы по области и
+ближайшие соседи, а также объединение одного объекта, увиденного на
+нескольких кадрах (по треку или по близости на карте).
+
+    python spatial_index.py build panorama_homographies.jsonl detections.npz -o index.npz --frame-scale 0.5
+    python spatial_index.py query index.npz --region 0 0 2000 1000 --cls 2 --unique
+    python spatial_index.py selftest
+"""
+import argparse
+
+import numpy as np
+
+from checkpoint import load_homographies
+from matcher import GridIndex
+
+COLUMNS = ("frame", "time", "track", "cls", "conf", "frame_box", "box", "center")
+
+
+class FrameHomographies:
+    """Гомографии кадр -> карта для любых кадров по гомографиям ключевых кадров.
+
+    Между ключевыми кадрами матрица интерполируется линейно, за крайними
+    ключевыми кадрами берётся ближайшая, но не дальше max_gap кадров.
+    """
+
+    def __init__(self, homographies, max_gap=240):
+        self.frames = np.array(sorted(homographies), dtype=np.int64)
+        self.H = np.array([homographies[i] / homographies[i][2, 2] for i in self.frames], dtype=np.float64)
+        self.max_gap = max_gap
+
+    def lookup(self, frames):
+        """Гомографии (n, 3, 3) для индексов кадров frames и маска кадров, для которых она есть."""
+        frames = np.asarray(frames, dtype=np.int64)
+        if len(self.frames) == 0:
+            return np.zeros((len(frames), 3, 3)), np.zeros(len(frames), bool)
+        if len(self.frames) == 1:
+            H = np.repeat(self.H, len(frames), axis=0)
+        else:
+            right = np.clip(np.searchsorted(self.frames, frames, "right"), 1, len(self.frames) - 1)
+            f0, f1 = self.frames[right - 1], self.frames[right]
+            weight = np.clip((frames - f0) / (f1 - f0), 0, 1)[:, None, None]
+            H = (1 - weight) * self.H[right - 1] + weight * self.H[right]
+        gap = np.maximum(self.frames[0] - frames, frames - self.frames[-1])
+        return H, gap <= self.max_gap
+
+
+def project_boxes(boxes, H):
+    """Рамки xyxy (n, 4) через гомографии H (n, 3, 3): рамка проекции углов и проекция центра."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    x1, y1, x2, y2 = boxes.T
+    points = np.stack([
+        np.stack([x1, y1], 1), np.stack([x2, y1], 1), np.stack([x2, y2], 1), np.stack([x1, y2], 1),
+        np.stack([(x1 + x2) / 2, (y1 + y2) / 2], 1),
+    ], axis=1)
+    points = np.concatenate([points, np.ones(points.shape[:2] + (1,))], axis=2)
+    projected = np.einsum("nij,nkj->nki", H, points)
+    projected = projected[..., :2] / projected[..., 2:]
+    corners = projected[:, :4]
+    box = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+    return box.astype(np.float32), projected[:, 4].astype(np.float32)
+
+
+class SpatialIndex:
+    """Детекции в координатах карты с сеточным индексом по центрам рамок.
+
+    Хранение колоночное (массивы NumPy), новые детекции копятся частями и
+    склеиваются при первом запросе, тогда же перестраивается сетка с
+    ячейкой cell пикселей карты. frame_scale переводит пиксели кадра
+    детектора в пиксели кадра, по которому строилась карта (например, 0.5,
+    если детектор работал на кадре вдвое больше).
+    """
+
+    def __init__(self, homographies=None, cell=64.0, fps=None, frame_scale=1.0, max_gap=240):
+        self.homographies = None if homographies is None else FrameHomographies(homographies, max_gap)
+        self.max_gap = max_gap
+        self.cell = cell
+        self.fps = fps
+        self.frame_scale = np.diag([*np.broadcast_to(np.asarray(frame_scale, np.float64), (2,)), 1.0])
+        self.columns = {name: [] for name in COLUMNS}
+        self.data = None
+        self.grid = None
+        self.object_ids = None
+        self.dedupe_key = None
+
+    def __len__(self):
+        self._consolidate()
+        return len(self.data["frame"])
+
+    def add(self, frames, boxes, conf=None, cls=None, track=None):
+        """Добавляет детекции: frames - индекс кадра на каждую рамку (или один на все). Возвращает число добавленных.
+
+        Детекции кадров без гомографии (вне построенной карты) пропускаются.
+        """
+        if self.homographies is None:
+            raise ValueError("SpatialIndex.add() requires frame homographies; the index was created without them")
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        n = len(boxes)
+        frames = np.broadcast_to(np.asarray(frames, dtype=np.int64), (n,))
+        conf = np.ones(n, np.float32) if conf is None else np.asarray(conf, np.float32).reshape(n)
+        cls = np.zeros(n, np.int32) if cls is None else np.asarray(cls, np.int32).reshape(n)
+        track = np.full(n, -1, np.int64) if track is None else np.asarray(track, np.int64).reshape(n)
+
+        H, valid = self.homographies.lookup(frames)
+        H = H[valid] @ self.frame_scale
+        box, center = project_boxes(boxes[valid], H)
+        frames = frames[valid]
+        time = frames / self.fps if self.fps else np.full(len(frames), np.nan)
+        for name, values in (("frame", frames), ("time", time), ("track", track[valid]), ("cls", cls[valid]),
+                             ("conf", conf[valid]), ("frame_box", boxes[valid]), ("box", box), ("center", center)):
+            self.columns[name].append(values)
+        self.data = None
+        self.object_ids = None
+        return int(valid.sum())
+
+    def region(self, x0, y0, x1, y1, cls=None, t0=None, t1=None, unique=False, radius=None):
+        """Индексы детекций с центром в прямоугольнике, по возрастанию.
+
+        cls - класс или список классов, t0/t1 - диапазон кадров. С unique
+        от каждого объекта (deduplicate(radius)) остаётся одна детекция с
+        наибольшей уверенностью.
+        """
+        self._consolidate()
+        candidates = self.grid.region(x0, y0, x1, y1)
+        center = self.data["center"][candidates]
+        inside = (center[:, 0] >= x0) & (center[:, 0] < x1) & (center[:, 1] >= y0) & (center[:, 1] < y1)
+        result = self._filter(np.sort(candidates[inside]), cls, t0, t1)
+        if unique:
+            ids = self.deduplicate(radius)[result]
+            order = np.lexsort((-self.data["conf"][result], ids))
+            first = np.r_[True, ids[order][1:] != ids[order][:-1]]
+            result = np.sort(result[order][first])
+        return result
+
+    def nearest(self, x, y, k=1, cls=None, max_distance=np.inf):
+        """Индексы k ближайших к точке (x, y) детекций и расстояния до них."""
+        self._consolidate()
+        center = self.data["center"]
+        if len(center) == 0:
+            return np.empty(0, np.intp), np.empty(0, np.float32)
+        lo, hi = center.min(axis=0), center.max(axis=0)
+        # Квадрат с половиной стороны reach накрывает все детекции
+        reach = max(abs(x - lo[0]), abs(x - hi[0]), abs(y - lo[1]), abs(y - hi[1])) + 1
+        radius = self.cell
+        while True:
+            # В квадрате с половиной стороны radius найдены все точки ближе radius
+            candidates = self._filter(self.grid.region(x - radius, y - radius, x + radius, y + radius), cls)
+            distance = np.linalg.norm(center[candidates] - (x, y), axis=1)
+            if (distance <= radius).sum() >= k or radius >= min(reach, max_distance):
+                order = np.argsort(distance)[:k]
+                found, distance = candidates[order], distance[order]
+                keep = distance <= max_distance
+                return found[keep], distance[keep]
+            radius *= 2
+
+    def deduplicate(self, radius=None, max_frames=None):
+        """Номер объекта для каждой детекции.
+
+        Детекции одного трека - один объект. Детекции с разных кадров одного
+        класса с центрами ближе radius (по умолчанию cell) связываются, если
+        каждая - ближайшая к другой среди детекций её кадра, у них не разные
+        треки и (при max_frames) кадры не дальше max_frames друг от друга.
+        Объект никогда не содержит двух детекций одного кадра или двух
+        разных треков: стоящие рядом машины остаются разными объектами.
+        """
+        self._consolidate()
+        radius = self.cell if radius is None else radius
+        if self.object_ids is not None and self.dedupe_key == (radius, max_frames):
+            return self.object_ids
+
+        data = self.data
+        n = len(data["frame"])
+        frame, track, cls = data["frame"], data["track"], data["cls"]
+        source, target, distance = [], [], []
+        grid = GridIndex(data["center"], radius)
+        for query, train in grid.neighbourhoods(data["center"]):
+            # Все соседи точки ближе radius - в блоке, поэтому ближайшая детекция каждого кадра ищется здесь же
+            train = train[np.argsort(frame[train], kind="stable")]
+            offset = data["center"][query, None] - data["center"][None, train]
+            dist = np.einsum("ijk,ijk->ij", offset, offset)
+            ok = (dist <= radius * radius) & (cls[query, None] == cls[None, train])
+            ok &= frame[query, None] != frame[None, train]
+            ok &= (track[query, None] < 0) | (track[None, train] < 0) | (track[query, None] == track[None, train])
+            if max_frames is not None:
+                ok &= np.abs(frame[query, None] - frame[None, train]) <= max_frames
+            dist = np.where(ok, dist, np.inf)
+            starts = np.flatnonzero(np.r_[True, frame[train][1:] != frame[train][:-1]])
+            best = np.minimum.reduceat(dist, starts, axis=1)
+            segment = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(train))))
+            rows, cols = np.nonzero(ok & (dist <= best[:, segment]))
+            source.append(query[rows])
+            target.append(train[cols])
+            distance.append(dist[rows, cols])
+        source = np.concatenate(source or [np.empty(0, np.int64)])
+        target = np.concatenate(target or [np.empty(0, np.int64)])
+        distance = np.concatenate(distance or [np.empty(0, np.float32)])
+
+        # Пара остаётся, только если детекции взаимно ближайшие для кадров друг друга
+        forward = source < target
+        backward = np.asarray(target[~forward], np.int64) * n + source[~forward]
+        first, second, distance = source[forward], target[forward], distance[forward]
+        mutual = np.isin(np.asarray(first, np.int64) * n + second, backward, assume_unique=True)
+        first, second, distance = first[mutual], second[mutual], distance[mutual]
+
+        # Детекции одного трека связываем с первой детекцией этого трека
+        tracked = np.flatnonzero(track >= 0)
+        if len(tracked):
+            _, head = np.unique(track[tracked], return_inverse=True)
+            leader = np.full(head.max() + 1, n, np.int64)
+            np.minimum.at(leader, head, tracked)
+            # Связи трека идут в объединение первыми
+            first = np.concatenate([leader[head], first])
+            second = np.concatenate([tracked, second])
+            distance = np.concatenate([np.full(len(tracked), -1.0, np.float32), distance])
+
+        labels = _components(n, first, second)
+        conflicted = _conflicts(labels, frame, track)
+        if len(conflicted):
+            # Цепочки связей собрали в объект детекции одного кадра: такие объекты собираются заново с проверкой
+            inside = np.isin(labels[first], conflicted)
+            members = np.flatnonzero(np.isin(labels, conflicted))
+            labels[members] = members
+            order = np.argsort(distance[inside], kind="stable")
+            _constrained_union(labels, first[inside][order], second[inside][order], frame, track)
+
+        self.object_ids = labels
+        self.dedupe_key = (radius, max_frames)
+        return self.object_ids
+
+    def objects(self, radius=None, max_frames=None):
+        """Сводка по объектам: центр (среднее), класс, первый и последний кадр, число детекций, лучшая уверенность."""
+        ids = self.deduplicate(radius, max_frames)
+        data = self.data
+        if len(ids) == 0:
+            return dict(id=np.empty(0, np.int64), center=np.empty((0, 2), np.float32), cls=np.empty(0, np.int32),
+                        first_frame=np.empty(0, np.int64), last_frame=np.empty(0, np.int64),
+                        count=np.empty(0, np.int64), conf=np.empty(0, np.float32), track=np.empty(0, np.int64))
+        count = np.bincount(ids)
+        present = np.flatnonzero(count)
+        count = count[present]
+        center = np.stack([np.bincount(ids, data["center"][:, i])[present] for i in range(2)], axis=1) / count[:, None]
+        first = np.full(ids.max() + 1, np.iinfo(np.int64).max)
+        last = np.full(ids.max() + 1, np.iinfo(np.int64).min)
+        best = np.full(ids.max() + 1, -np.inf, np.float32)
+        np.minimum.at(first, ids, data["frame"])
+        np.maximum.at(last, ids, data["frame"])
+        np.maximum.at(best, ids, data["conf"])
+        cls = np.zeros(ids.max() + 1, np.int32)
+        cls[ids] = data["cls"]
+        track = np.full(ids.max() + 1, -1, np.int64)
+        np.maximum.at(track, ids, data["track"])
+        return dict(id=present, center=center.astype(np.float32), cls=cls[present], first_frame=first[present],
+                    last_frame=last[present], count=count, conf=best[present], track=track[present])
+
+    def save(self, path):
+        """Пишет детекции и гомографии кадров, чтобы в загруженный индекс можно было добавлять детекции."""
+        self._consolidate()
+        homographies = self.homographies
+        frames = np.empty(0, np.int64) if homographies is None else homographies.frames
+        H = np.empty((0, 3, 3)) if homographies is None else homographies.H
+        np.savez(path, cell=self.cell, fps=np.nan if self.fps is None else self.fps, max_gap=self.max_gap,
+                 frame_scale=np.diag(self.frame_scale)[:2], homography_frames=frames, homographies=H, **self.data)
+
+    @classmethod
+    def load(cls, path):
+        archive = np.load(path)
+        fps = float(archive["fps"])
+        homographies = None
+        # Индексы, сохранённые без гомографий, загружаются только для запросов
+        if "homographies" in archive and len(archive["homographies"]):
+            homographies = dict(zip(archive["homography_frames"].tolist(), archive["homographies"]))
+        index = cls(homographies, cell=float(archive["cell"]), fps=None if np.isnan(fps) else fps,
+                    frame_scale=archive["frame_scale"] if "frame_scale" in archive else 1.0,
+                    max_gap=int(archive["max_gap"]) if "max_gap" in archive else 240)
+        for name in COLUMNS:
+            index.columns[name].append(archive[name])
+        return index
+
+    def _consolidate(self):
+        # Части, накопленные add(), склеиваются при первом запросе, тогда же строится сетка
+        if self.data is not None:
+            return
+        self.data = {}
+        for name, parts in self.columns.items():
+            if parts:
+                self.data[name] = np.concatenate(parts)
+            elif name in ("frame_box", "box", "center"):
+                self.data[name] = np.empty((0, 2 if name == "center" else 4), np.float32)
+            else:
+                self.data[name] = np.empty(0, np.int64 if name in ("frame", "track", "cls") else np.float32)
+            self.columns[name] = [self.data[name]]
+        self.grid = GridIndex(self.data["center"], self.cell)
+
+    def _filter(self, indices, cls=None, t0=None, t1=None):
+        data = self.data
+        keep = np.ones(len(indices), bool)
+        if cls is not None:
+            keep &= np.isin(data["cls"][indices], np.atleast_1d(cls))
+        if t0 is not None:
+            keep &= data["frame"][indices] >= t0
+        if t1 is not None:
+            keep &= data["frame"][indices] <= t1
+        return indices[keep]
+
+
+def _components(n, first, second):
+    """Связные компоненты графа на n вершинах с рёбрами (first, second): номер компоненты = меньшая вершина."""
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, low)
+        np.minimum.at(updated, second, low)
+        # Перескок по указателям ускоряет сходимость на длинных цепочках
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def _conflicts(labels, frames, tracks):
+    """Компоненты, в которых есть две детекции одного кадра или два разных трека."""
+    order = np.lexsort((frames, labels))
+    label, frame = labels[order], frames[order]
+    same_frame = label[np.flatnonzero((label[1:] == label[:-1]) & (frame[1:] == frame[:-1]))]
+    tracked = tracks >= 0
+    low = np.full(len(labels), np.iinfo(np.int64).max)
+    high = np.full(len(labels), -1)
+    np.minimum.at(low, labels[tracked], tracks[tracked])
+    np.maximum.at(high, labels[tracked], tracks[tracked])
+    two_tracks = np.flatnonzero((high >= 0) & (low != high))
+    return np.union1d(same_frame, two_tracks)
+
+
+def _constrained_union(labels, first, second, frames, tracks):
+    """Объединение по рёбрам в заданном порядке с отказом от слияний, дающих две детекции кадра или два трека.
+
+    labels - начальные номера (каждая участвующая вершина - сама себе
+    корень), меняется на месте: номер объекта - меньшая вершина.
+    """
+    parent = {}
+    members = {}
+    frame_sets = {}
+    track_of = {}
+
+    def find(v):
+        root = v
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while v != root:
+            parent[v], v = root, parent[v]
+        return root
+
+    for u, v in zip(first.tolist(), second.tolist()):
+        for w in (u, v):
+            if w not in parent:
+                parent[w] = w
+                members[w] = [w]
+                frame_sets[w] = {int(frames[w])}
+                track_of[w] = int(tracks[w])
+        ru, rv = find(u), find(v)
+        if ru == rv or not frame_sets[ru].isdisjoint(frame_sets[rv]):
+            continue
+        tu, tv = track_of[ru], track_of[rv]
+        if tu >= 0 and tv >= 0 and tu != tv:
+            continue
+        if len(members[ru]) < len(members[rv]):
+            ru, rv = rv, ru
+        parent[rv] = ru
+        members[ru] += members.pop(rv)
+        frame_sets[ru] |= frame_sets.pop(rv)
+        track_of[ru] = max(tu, tv)
+    for group in members.values():
+        labels[group] = min(group)
+
+
+def load_detections(path):
+    """Детекции из .npz с колонками frame, boxes (xyxy в пикселях кадра) и необязательными conf, cls, track."""
+    archive = np.load(path)
+    return {name: archive[name] for name in ("frame", "boxes", "conf", "cls", "track") if name in archive}
+
+
+def selftest():
+    """Проверки объединения детекций на синтетических сценах (карта = кадр, единичные гомографии)."""
+    index = SpatialIndex({0: np.eye(3), 10: np.eye(3)})
+    # Ряд из 10 припаркованных машин через 30 пикселей, каждая видна на кадрах 0 и 10 со сдвигом в 3 пикселя
+    x = np.arange(10) * 30.0
+    boxes = np.stack([x, np.zeros(10), x + 20, np.full(10, 40.0)], axis=1)
+    index.add(0, boxes, cls=np.full(10, 2))
+    index.add(10, boxes + (3, 0, 3, 0), cls=np.full(10, 2))
+    objects = index.objects()
+    assert len(objects["id"]) == 10, f"parked row: {len(objects['id'])} objects instead of 10"
+    assert (objects["count"] == 2).all(), "parked row: each car must be seen twice"
+    assert len(index.region(-10, -10, 400, 100, unique=True)) == 10, "parked row: unique region query"
+
+    # Цепочка с дрейфом: на кадрах 0..3 одна машина сдвигается на 40 пикселей за кадр, на кадре 0 рядом вторая
+    chain = SpatialIndex({0: np.eye(3), 3: np.eye(3)})
+    for frame in range(4):
+        chain.add(frame, [[40.0 * frame, 0, 40.0 * frame + 20, 20]])
+    chain.add(0, [[120.0, 0, 140, 20]])
+    ids = chain.deduplicate()
+    frames = chain.data["frame"]
+    for object_id in np.unique(ids):
+        assert len(np.unique(frames[ids == object_id])) == (ids == object_id).sum(), "object holds two detections of one frame"
+
+    # Один трек - один объект даже при больших сдвигах; разные треки не сливаются
+    tracks = SpatialIndex({0: np.eye(3), 5: np.eye(3)})
+    tracks.add(np.arange(5), [[100.0 * i, 0, 100.0 * i + 20, 20] for i in range(5)], track=np.ones(5))
+    tracks.add(np.arange(5), [[100.0 * i + 10, 0, 100.0 * i + 30, 20] for i in range(5)], track=np.full(5, 2))
+    assert len(tracks.objects()["id"]) == 2, "tracks: two tracks must stay two objects"
+
+    # Пустой индекс
+    assert len(SpatialIndex({0: np.eye(3)}).objects()["id"]) == 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Spatial index of detections projected into map coordinates.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Project detections and save the index")
+    build.add_argument("homographies", help="{map}_homographies.jsonl written by main.py")
+    build.add_argument("detections", help=".npz with frame, boxes and optional conf, cls, track")
+    build.add_argument("-o", "--output", default="index.npz")
+    build.add_argument("--cell", type=float, default=64.0, help="Grid cell size in map pixels")
+    build.add_argument("--fps", type=float, help="Video frame rate for timestamps")
+    build.add_argument("--frame-scale", type=float, default=1.0, help="Detector frame pixels -> mapping frame pixels")
+    query = commands.add_parser("query", help="Query a saved index")
+    query.add_argument("index")
+    where = query.add_mutually_exclusive_group(required=True)
+    where.add_argument("--region", type=float, nargs=4, metavar=("X0", "Y0", "X1", "Y1"))
+    where.add_argument("--nearest", type=float, nargs=2, metavar=("X", "Y"))
+    query.add_argument("-k", type=int, default=5)
+    query.add_argument("--cls", type=int, nargs="+")
+    query.add_argument("--unique", action="store_true", help="One detection per object")
+    commands.add_parser("selftest", help="Check deduplication on synthetic scenes")
+    args = parser.parse_args(argv)
+
+    if args.command == "selftest":
+        selftest()
+        print("OK")
+        return
+
+    if args.command == "build":
+        index = SpatialIndex(load_homographies(args.homographies), args.cell, args.fps, args.frame_scale)
+        detections = load_detections(args.detections)
+        added = index.add(detections["frame"], detections["boxes"], detections.get("conf"), detections.get("cls"),
+                          detections.get("track"))
+        index.save(args.output)
+        objects = index.objects()
+        print(f"Детекций на карте: {added} из {len(detections['frame'])}, объектов: {len(objects['id'])}")
+        return
+
+    index = SpatialIndex.load(args.index)
+    if args.nearest is not None:
+        found, distance = index.nearest(*args.nearest, k=args.k, cls=args.cls)
+    else:
+        found = index.region(*args.region, cls=args.cls, unique=args.unique)
+        distance = None
+    data = index.data
+    for i, j in enumerate(found):
+        extra = "" if distance is None else f"  {distance[i]:.1f} px"
+        print(f"frame {data['frame'][j]:6d}  cls {data['cls'][j]:3d}  track {data['track'][j]:5d}  "
+              f"conf {data['conf'][j]:.2f}  center ({data['center'][j][0]:.1f}, {data['center'][j][1]:.1f}){extra}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+def current_rss_mb():
+    """Текущий RSS процесса в МБ или None, если узнать нельзя."""
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в МБ."""
+    # На Linux ru_maxrss переживает exec и достаётся от родителя, а VmHWM считается заново
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2**20
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+
+
+def stage(trace, name, frame=None):
+    """trace.stage(name) или пустой контекст, если трассировка выключена."""
+    return nullcontext() if trace is None else trace.stage(name, frame)
+
+
+class Trace:
+    """Трассировка этапов построения карты по ключевым кадрам.
+
+    Время этапов (decode, convert, select, detect, match, ransac, warp,
+    blend, write) и счётчики (точки, совпадения, инлаеры, размер полотна,
+    память) собираются для каждого ключевого кадра и по end_frame()
+    пишутся строкой JSON в path. Этапы, выполняемые в других потоках и
+    процессах (чтение кадров, извлечение признаков), передают время через
+    record() с индексом кадра. summary() считает перцентили по всему запуску;
+    кадры со status="failed" (не легли на карту) в число ключевых кадров не
+    входят и считаются отдельно.
+    """
+
+    def __init__(self, path=None):
+        self.file = open(path, "w") if path is not None else None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.frames = []
+        self.events = []
+
+    @contextmanager
+    def stage(self, name, frame=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(frame, name, time.perf_counter() - start)
+
+    @contextmanager
+    def timed(self, name, **values):
+        """Замеряет блок вне ключевых кадров и пишет его как событие (см. event)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.event(name, seconds=time.perf_counter() - start, **values)
+
+    def record(self, frame, name, seconds):
+        """Добавляет время этапа name к кадру frame (None - текущий кадр основного цикла)."""
+        with self.lock:
+            stages = self.pending.setdefault(frame, {}).setdefault("stages", {})
+            stages[name] = stages.get(name, 0.0) + seconds
+
+    def count(self, frame=None, **values):
+        with self.lock:
+            self.pending.setdefault(frame, {}).update(values)
+
+    def end_frame(self, frame, **values):
+        """Закрывает запись ключевого кадра frame и пишет её в трассу."""
+        with self.lock:
+            record = self.pending.pop(frame, {})
+            current = self.pending.pop(None, {})
+        stages = record.pop("stages", {})
+        for name, seconds in current.pop("stages", {}).items():
+            stages[name] = stages.get(name, 0.0) + seconds
+        record.update(current)
+        record.update(values)
+        record = dict(frame=int(frame), time=time.time(), stages=stages, rss_mb=current_rss_mb(), **record)
+        self.frames.append(record)
+        self._write(record)
+
+    def event(self, name, **values):
+        """Событие вне ключевых кадров, например фоновая запись контрольной точки."""
+        record = dict(event=name, time=time.time(), **values)
+        with self.lock:
+            self.events.append(record)
+        self._write(record)
+
+    def summary(self):
+        """Итоги запуска: сумма и перцентили по этапам и числовым счётчикам."""
+        stages = {}
+        counters = {}
+        for record in self.frames:
+            for name, seconds in record["stages"].items():
+                stages.setdefault(name, []).append(seconds)
+            for name, value in record.items():
+                if name not in ("frame", "time", "stages") and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    counters.setdefault(name, []).append(value)
+        for record in self.events:
+            if "seconds" in record:
+                stages.setdefault(record["event"], []).append(record["seconds"])
+        failed = sum(record.get("status") == "failed" for record in self.frames)
+        return dict(
+            keyframes=len(self.frames) - failed,
+            failed=failed,
+            stages={name: _stats(values) for name, values in stages.items()},
+            counters={name: _stats(values) for name, values in counters.items()},
+        )
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Ключевых кадров: {summary['keyframes']}")
+        if summary["failed"]:
+            print(f"Не удалось совместить кадров: {summary['failed']}")
+        header = "".join(f"{'p' + str(p):>9s}" for p in PERCENTILES)
+        print(f"{'stage':12s}{'total':>9s}{header}{'max':>9s}")
+        for name, s in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+            values = "".join(f"{s['p' + str(p)] * 1000:9.1f}" for p in PERCENTILES)
+            print(f"{name:12s}{s['total']:9.2f}{values}{s['max'] * 1000:9.1f}   (total, s; percentiles, ms)")
+        for name, s in sorted(summary["counters"].items()):
+            values = "".join(f"{s['p' + str(p)]:9.1f}" for p in PERCENTILES)
+            print(f"{name:12s}{'':9s}{values}{s['max']:9.1f}")
+        return summary
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _write(self, record):
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+
+def _stats(values):
+    values = np.asarray(values, dtype=np.float64)
+    stats = dict(count=len(values), total=float(values.sum()), mean=float(values.mean()), max=float(values.max()))
+    for p in PERCENTILES:
+        stats[f"p{p}"] = float(np.percentile(values, p))
+    return stats